@@ -13,6 +13,12 @@ SECRET_KEY = os.environ['DJANGO_SECRET_KEY']
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 DATA_DIR = os.path.join(BASE_DIR, 'data')
 
+# Generated by `manage.py build_jieba_dict`
+JIEBA_DICT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'jieba')
+
+# Default engine for splitting text into words: 'jieba', or 'trie' for the maximum-match segmenter in reading/trie.py
+SEGMENTATION_ENGINE = 'jieba'
+
 
 ALLOWED_HOSTS = [
     'localhost',
@@ -113,10 +119,42 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Threads for blocking work in websocket consumers (see consumer_utils.py), and how long a consumer can run on the
+# event loop between awaits (in seconds) before we warn about it
+CONSUMER_THREAD_POOL_SIZE = 8
+CONSUMER_SLOW_STEP_WARNING = 0.05
+
+# Phrase translations are sent to readers in batches, at most this often (in seconds) or this many at a time
+PHRASE_UPDATE_MAX_DELAY = 0.1
+PHRASE_UPDATE_MAX_ITEMS = 20
+
 CELERY_BROKER_URL = f"redis://:{os.environ['REDIS_PASSWORD']}@redis:6379/0"
 CELERY_RESULT_BACKEND = f"redis://:{os.environ['REDIS_PASSWORD']}@redis:6379/0"
 CELERY_TASK_DEFAULT_QUEUE = 'default'
 
+# How often (in seconds) each process checks whether the dictionary has changed since it loaded its dictionary index,
+# and reloads it if so
+DICTIONARY_INDEX_CHECK_INTERVAL = 5
+
+# When Words are created, the articles containing them are re-annotated (see tasks.reannotate_articles_with_words).
+# They're looked for this many Words per query
+REANNOTATE_WORDS_PER_QUERY = 100
+
+# process_article splits an article's text nodes between this many tasks, which annotate them in parallel
+ANNOTATION_TASKS_PER_ARTICLE = 4
+
+# Store each new article's Word and CP annotations as one packed blob (PackedAnnotations) rather than thousands of
+# Annotation rows. Existing articles can be converted either way with the pack_annotations command
+PACK_WORD_ANNOTATIONS = False
+
+# Render each article's inflated XML when it's requested rather than storing it in Article.inflated. Rendered XML is
+# kept in a per-process LRU cache holding up to this many characters in total, and isn't stored in ReaderPayload either.
+# After changing this, invalidate the stored payloads with ReaderPayload.objects.invalidate_all(). Incremental updates
+# to the segmentation don't work in this mode: the Celery worker doesn't have the XML cached, so readers are sent the
+# whole article instead (see inflate.reinflate_text_nodes)
+LAZY_INFLATION = False
+INFLATED_CACHE_MAX_CHARS = 50_000_000
+
 
 SHELL_PLUS_POST_IMPORTS = [
     ('shell_plus', '*')
@@ -138,6 +176,21 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media/')
 LOGIN_URL = '/accounts/login'
 OPENAI_API_KEY = os.environ['OPENAI_API_KEY']
 
+# Requests and tokens per minute for each model (see gpt_scheduler.py). These are adjusted downwards at runtime from
+# OpenAI's rate limit headers, so they only need to be roughly right.
+OPENAI_RATE_LIMITS = {
+    'default': {'rpm': 500, 'tpm': 200000},
+    'gpt-3.5-turbo': {'rpm': 3500, 'tpm': 200000},
+    'gpt-4o': {'rpm': 500, 'tpm': 30000},
+    'gpt-4o-2024-08-06': {'rpm': 500, 'tpm': 30000},
+}
+OPENAI_MAX_CONCURRENCY = 16  # Per event loop
+OPENAI_RATE_LIMIT_REDIS_URL = f"redis://:{os.environ['REDIS_PASSWORD']}@redis:6379/1"
+
+# Cached phrase translations are evicted once they're this old, or (least recently used first) when there are more
+PHRASE_TRANSLATION_CACHE_TTL = datetime.timedelta(days=90)
+PHRASE_TRANSLATION_CACHE_SIZE = 200000
+
 REST_FRAMEWORK = {
     # Use Django's standard `django.contrib.auth` permissions,
     # or allow read-only access for unauthenticated users.
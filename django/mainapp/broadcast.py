@@ -0,0 +1,52 @@
+"""
+Batching of updates sent to channel layer groups.
+"""
+import asyncio
+
+from channels.layers import get_channel_layer
+
+
+class CoalescingGroupSender:
+    """
+    Buffers messages for a group, and sends them as a single message (with a list of all of them) once max_items have
+    been added, or max_delay seconds after the first one was added. Use as an async context manager, so anything still
+    buffered is sent at the end.
+    """
+
+    def __init__(self, group, message_type, max_delay=0.1, max_items=20):
+        self.group = group
+        self.message_type = message_type
+        self.max_delay = max_delay
+        self.max_items = max_items
+        self.items = []
+        self._timer = None
+
+    async def add(self, item):
+        self.items.append(item)
+        if len(self.items) >= self.max_items:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.max_delay)
+        self._timer = None
+        await self.flush()
+
+    async def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        items, self.items = self.items, []
+        if items:
+            await get_channel_layer().group_send(self.group, {
+                'type': self.message_type,
+                'message': items,
+            })
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.flush()
@@ -0,0 +1,95 @@
+"""
+Helpers for keeping websocket consumers from blocking Daphne's event loop.
+
+Blocking work (database queries, anything CPU heavy) goes through database_sync_to_async/run_sync below, which run it
+in a dedicated, bounded thread pool - rather than channels' default, which runs every consumer's queries one at a time
+in a single thread. Consumers subclass InstrumentedWebsocketConsumer, which records how long each of their handlers
+actually runs on the event loop (not counting time spent awaiting), and warns when a single step blocks it for too long.
+"""
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import SyncToAsync
+from channels.db import DatabaseSyncToAsync
+from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+
+executor = ThreadPoolExecutor(max_workers=settings.CONSUMER_THREAD_POOL_SIZE, thread_name_prefix='consumer')
+
+
+def database_sync_to_async(func):
+    # Each thread keeps its own connection, so the pool size also bounds the number of connections
+    return DatabaseSyncToAsync(func, thread_sensitive=False, executor=executor)
+
+
+def run_sync(func):
+    return SyncToAsync(func, thread_sensitive=False, executor=executor)
+
+
+class _TimedCoroutine:
+    """
+    Awaits coro, calling on_step with the duration of each step it runs on the event loop (i.e. between awaits).
+    """
+
+    def __init__(self, coro, on_step):
+        self.coro = coro
+        self.on_step = on_step
+
+    def __await__(self):
+        value, exc = None, None
+        while True:
+            start = time.perf_counter()
+            try:
+                if exc is None:
+                    signal = self.coro.send(value)
+                else:
+                    signal = self.coro.throw(exc)
+            except StopIteration as e:
+                self.on_step(time.perf_counter() - start)
+                return e.value
+            except BaseException:
+                self.on_step(time.perf_counter() - start)
+                raise
+            self.on_step(time.perf_counter() - start)
+
+            try:
+                value, exc = (yield signal), None
+            except BaseException as e:
+                value, exc = None, e
+
+
+class InstrumentedWebsocketConsumer(AsyncWebsocketConsumer):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loop_time = 0
+        self.max_step_time = 0
+        self.n_messages = 0
+
+    def _record_step(self, duration, description):
+        self.loop_time += duration
+        self.max_step_time = max(self.max_step_time, duration)
+        if duration > settings.CONSUMER_SLOW_STEP_WARNING:
+            print(f"UserWarning: {type(self).__name__} blocked the event loop for {duration * 1000:.0f}ms "
+                  f"handling {description}")
+
+    def timed(self, coro, description):
+        return _TimedCoroutine(coro, lambda duration: self._record_step(duration, description))
+
+    def create_task(self, coro, description):
+        """
+        Like asyncio.create_task, but the task's time on the event loop counts towards this consumer's.
+        """
+        async def run():
+            return await self.timed(coro, description)
+        return asyncio.create_task(run())
+
+    async def dispatch(self, message):
+        self.n_messages += 1
+        try:
+            await self.timed(super().dispatch(message), message['type'])
+        finally:
+            if message['type'] == 'websocket.disconnect':
+                print(f"{type(self).__name__}: {self.n_messages} messages, {self.loop_time * 1000:.1f}ms on the event "
+                      f"loop (longest step {self.max_step_time * 1000:.1f}ms)")
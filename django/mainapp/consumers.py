@@ -1,16 +1,18 @@
+import asyncio
 import textwrap
+import traceback
 from urllib.parse import parse_qs
 
-from channels.db import database_sync_to_async
-from channels.generic.websocket import AsyncWebsocketConsumer
 import json
 
+from django.db import DEFAULT_DB_ALIAS
+
 from mainapp import gpt
+from mainapp.consumer_utils import InstrumentedWebsocketConsumer, database_sync_to_async
 from mainapp.models import Article, PhraseAnnotation, Word, CharacterPinyin
 
 
 def get_client_ip_ws(consumer):
-    print(str(consumer.scope))
     x_real_ip = dict(consumer.scope['headers']).get(b'x-real-ip')
     if x_real_ip:
         return x_real_ip.decode()
@@ -19,12 +21,13 @@ def get_client_ip_ws(consumer):
 
 
 # Updates the article loading page (while data is being scraped from article URL, before article content is there)
-class ArticleLoadingConsumer(AsyncWebsocketConsumer):
+class ArticleLoadingConsumer(InstrumentedWebsocketConsumer):
     async def connect(self):
         article_pk = self.scope['url_route']['kwargs']['pk']
-        self.article = await database_sync_to_async(self.get_article)(article_pk)
 
-        # Add this consumer to the group for this article
+        # Add this consumer to the group for this article. The group name only needs the pk, so use a stand-in rather
+        # than fetching the article twice
+        self.article = Article.from_db(DEFAULT_DB_ALIAS, ['id'], [article_pk])
         await self.channel_layer.group_add(
             self.article.loading_channel_name,
             self.channel_name
@@ -61,7 +64,7 @@ class ArticleLoadingConsumer(AsyncWebsocketConsumer):
 
 
 # Updates the article detail page with summary and translations
-class ArticleProgressConsumer(AsyncWebsocketConsumer):
+class ArticleProgressConsumer(InstrumentedWebsocketConsumer):
     async def connect(self):
         article_pk = self.scope['url_route']['kwargs']['pk']
         self.article = await database_sync_to_async(self.get_article)(article_pk)
@@ -90,6 +93,12 @@ class ArticleProgressConsumer(AsyncWebsocketConsumer):
             'data': message
         }))
 
+    async def phrases_update(self, event):
+        await self.send(text_data=json.dumps({
+            'type': 'phrases',
+            'data': event['message'],
+        }))
+
     async def summary_update(self, event):
         message = event['message']
         await self.send(text_data=json.dumps({
@@ -119,28 +128,28 @@ class ArticleProgressConsumer(AsyncWebsocketConsumer):
         }))
 
 
-class ChatConsumer(AsyncWebsocketConsumer):
+class ChatConsumer(InstrumentedWebsocketConsumer):
 
     async def connect(self):
 
         article_pk = self.scope['url_route']['kwargs']['pk']
-        self.article = await database_sync_to_async(self.get_article)(article_pk)
 
         query_params = parse_qs(self.scope['query_string'].decode())
         phrase_pk = query_params.get('phrasePk', [None])[0]
         obj_pk = query_params.get('objPk', [None])[0]
         obj_type = query_params.get('objType', [None])[0]
 
-        await self.get_prompt_context(phrase_pk, obj_pk, obj_type)
+        await self.get_prompt_context(article_pk, phrase_pk, obj_pk, obj_type)
 
         self.conversation = []
+        self.response_task = None
+        self.is_closed = False
         await self.accept()
 
-    def get_article(self, pk):
-        return Article.objects.get(pk=pk)
-
     @database_sync_to_async
-    def get_prompt_context(self, phrase_pk, obj_pk, obj_type):
+    def get_prompt_context(self, article_pk, phrase_pk, obj_pk, obj_type):
+        # All in one trip to the thread pool
+        self.article = Article.objects.get(pk=article_pk)
         assert phrase_pk
         self.phrase_str = PhraseAnnotation.objects.get(pk=phrase_pk).text
         if obj_pk:
@@ -153,7 +162,10 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
 
     async def disconnect(self, close_code):
-        pass
+        # Stop generating a response nobody will see
+        self.is_closed = True
+        if self.response_task:
+            self.response_task.cancel()
 
     @property
     def conversation_with_prompt(self):
@@ -210,16 +222,39 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
         text_data_json = json.loads(text_data)
 
+        # If we're still answering the last message, finish with what we have so far
+        if self.response_task and not self.response_task.done():
+            self.response_task.cancel()
+            await asyncio.gather(self.response_task, return_exceptions=True)
+
         if 'resetConversation' in text_data_json:
             self.conversation = text_data_json['resetConversation']
         elif 'message' in text_data_json:
             msg = text_data_json['message']
             self.conversation.append({'sender': 'user', 'message': msg})
 
-        assistant_response = gpt.get_conversation_response(self.get_messages(), model="gpt-4o")
-        self.conversation.append({'sender': 'assistant', 'message': assistant_response})
-
-        await self.send(text_data=json.dumps({
-            'message': assistant_response,
-        }))
+        # Run this as a separate task, so we still receive disconnects and new messages while it streams
+        self.response_task = self.create_task(self.send_response(self.get_messages()), 'chat response')
+
+    async def send_response(self, messages):
+        # Sends each piece of the response as it arrives, then the whole response
+        assistant_response = ''
+        try:
+            async for delta in gpt.iter_conversation_response_async(messages, model="gpt-4o"):
+                assistant_response += delta
+                await self.send(text_data=json.dumps({
+                    'type': 'delta',
+                    'delta': delta,
+                }))
+        except gpt.GPTError:
+            traceback.print_exc()
+            assistant_response = assistant_response or "Sorry, something went wrong. Please try again."
+        finally:
+            if assistant_response:
+                self.conversation.append({'sender': 'assistant', 'message': assistant_response})
+                if not self.is_closed:
+                    await self.send(text_data=json.dumps({
+                        'type': 'done',
+                        'message': assistant_response,
+                    }))
 
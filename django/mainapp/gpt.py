@@ -9,13 +9,16 @@ from django.conf import settings
 import openai as openai
 from openai import RateLimitError
 
+from mainapp.gpt_scheduler import scheduler
+
 
 DEFAULT_MODEL = "gpt-3.5-turbo"
 
 N_ATTEMPTS = 5
 
-client = openai.OpenAI(api_key=settings.OPENAI_API_KEY)
-client_async = openai.AsyncOpenAI(api_key=settings.OPENAI_API_KEY)
+# Retries are handled below, so the scheduler sees every rate limited response
+client = openai.OpenAI(api_key=settings.OPENAI_API_KEY, max_retries=0)
+client_async = openai.AsyncOpenAI(api_key=settings.OPENAI_API_KEY, max_retries=0)
 
 class GPTError(Exception):
     pass
@@ -59,15 +62,17 @@ async def get_conversation_response_async(messages, json_keys=None, model=DEFAUL
     for attempt in range(N_ATTEMPTS):
         print(f"Calling GPT (attempt {attempt + 1})")
         try:
-            response = await client_async.chat.completions.create(
-                model=model,
-                messages=messages,
-            )
-        except RateLimitError:
-            for h in response.headers:
-                print(h)
-            print("Rate limited - retrying in about 1 second")
-            await asyncio.sleep(random.uniform(0.5, 1.5))
+            async with scheduler.limit(model, messages) as reservation:
+                raw_response = await client_async.chat.completions.with_raw_response.create(
+                    model=model,
+                    messages=messages,
+                )
+                response = raw_response.parse()
+                await reservation.aupdate(raw_response.headers, response.usage)
+        except RateLimitError as e:
+            delay = await scheduler.aon_rate_limited(model, e.response.headers, attempt)
+            print(f"Rate limited - retrying in {delay:.1f} seconds")
+            await asyncio.sleep(delay)
             continue
 
         except Exception as e:
@@ -81,6 +86,52 @@ async def get_conversation_response_async(messages, json_keys=None, model=DEFAUL
     raise GPTError(f"GPT failed after {N_ATTEMPTS} attempts")
 
 
+async def iter_conversation_response_async(messages, model=DEFAULT_MODEL):
+    """
+    Streams the response, yielding each piece of text as it arrives. Closing the generator (e.g. by cancelling the task
+    iterating over it) closes the connection, so OpenAI stops generating.
+    """
+
+    print(messages)
+    print(f"Model: {model}")
+
+    has_output = False
+    for attempt in range(N_ATTEMPTS):
+        print(f"Calling GPT (attempt {attempt + 1})")
+        try:
+            async with scheduler.limit(model, messages) as reservation:
+                stream = await client_async.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    stream=True,
+                    stream_options={'include_usage': True},
+                )
+                async with stream:
+                    await reservation.aupdate(stream.response.headers)
+                    async for chunk in stream:
+                        if chunk.usage:
+                            await reservation.aupdate(usage=chunk.usage)
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            has_output = True
+                            yield chunk.choices[0].delta.content
+            return
+
+        except RateLimitError as e:
+            delay = await scheduler.aon_rate_limited(model, e.response.headers, attempt)
+            print(f"Rate limited - retrying in {delay:.1f} seconds")
+            await asyncio.sleep(delay)
+            continue
+
+        except Exception as e:
+            # Once we've yielded part of a response, retrying would repeat it
+            if has_output:
+                raise GPTError(f"GPT response interrupted: {type(e).__name__}, Message: {str(e)}")
+            print(f"Error getting response from OpenAI, retrying. Error: {type(e).__name__}, Message: {str(e)}")
+            continue
+
+    raise GPTError(f"GPT failed after {N_ATTEMPTS} attempts")
+
+
 def get_conversation_response(messages, json_keys=None, model=DEFAULT_MODEL):
     print(messages)
     print(f"Model: {model}")
@@ -88,15 +139,17 @@ def get_conversation_response(messages, json_keys=None, model=DEFAULT_MODEL):
     for attempt in range(N_ATTEMPTS):
         print(f"Calling GPT (attempt {attempt + 1})")
         try:
-            response = client.chat.completions.create(
+            reservation = scheduler.limit_sync(model, messages)
+            raw_response = client.chat.completions.with_raw_response.create(
                 model=model,
                 messages=messages,
             )
-        except RateLimitError:
-            for h in response.headers:
-                print(h)
-            print("Rate limited - retrying in about 1 second")
-            time.sleep(random.uniform(0.5, 1.5))
+            response = raw_response.parse()
+            reservation.update(raw_response.headers, response.usage)
+        except RateLimitError as e:
+            delay = scheduler.on_rate_limited(model, e.response.headers, attempt)
+            print(f"Rate limited - retrying in {delay:.1f} seconds")
+            time.sleep(delay)
             continue
 
         except Exception as e:
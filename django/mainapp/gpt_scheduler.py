@@ -0,0 +1,280 @@
+"""
+Keeps GPT requests within OpenAI's rate limits.
+
+Each model has two token buckets, one for requests per minute and one for tokens per minute. A request reserves one
+request and an estimate of its tokens up front, waiting until both buckets can cover it, and the estimate is corrected
+once the response reports its usage. The buckets are also capped by the x-ratelimit-remaining-* headers OpenAI sends
+back, so we slow down when other processes (or other users of the API key) are using the same budget.
+
+With OPENAI_RATE_LIMIT_REDIS_URL set, the buckets live in Redis so all Celery workers and Daphne share them. Otherwise
+each process has its own, and while Redis is unreachable each process falls back to its own.
+"""
+import asyncio
+import contextlib
+import random
+import re
+import threading
+import time
+import weakref
+
+import redis
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+
+# After Redis fails, how long to use the process's own buckets before trying it again
+REDIS_RETRY_INTERVAL = 30
+
+
+def estimate_tokens(messages):
+    # Chinese text is roughly a token per character, English roughly four characters per token. Leave some room for
+    # the response too.
+    n_tokens = 0
+    for message in messages:
+        content = message['content'] or ''
+        n_non_ascii = sum(1 for c in content if ord(c) > 127)
+        n_tokens += n_non_ascii + (len(content) - n_non_ascii) // 4 + 4
+    return n_tokens + 200
+
+
+def get_backoff(attempt, headers=None):
+    """
+    Returns how long to wait before retrying after attempt (starting at 0) was rate limited: exponential backoff with
+    full jitter, but no less than OpenAI's retry-after header asks for.
+    """
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+    if headers:
+        if headers.get('retry-after-ms'):
+            delay = max(delay, float(headers['retry-after-ms']) / 1000)
+        elif headers.get('retry-after'):
+            with contextlib.suppress(ValueError):
+                delay = max(delay, float(headers['retry-after']))
+    return delay
+
+
+def _get_header_int(headers, name):
+    value = headers.get(name) if headers else None
+    return int(value) if value and re.fullmatch(r'\d+', value) else None
+
+
+class LocalTokenBucket:
+    """
+    A token bucket for this process. reserve() always takes the amount, letting the level go negative, and returns how
+    long the caller has to wait for the bucket to have refilled to cover it - so reservations queue up in order without
+    having to hold a lock while waiting.
+    """
+
+    def __init__(self, capacity, per_second):
+        self.capacity = capacity
+        self.per_second = per_second
+        self.level = capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.per_second)
+        self.updated_at = now
+
+    def reserve(self, amount):
+        with self._lock:
+            self._refill()
+            self.level -= amount
+            return max(0, -self.level / self.per_second)
+
+    def add(self, amount):
+        with self._lock:
+            self._refill()
+            self.level = min(self.capacity, self.level + amount)
+
+    def cap(self, remaining):
+        with self._lock:
+            self._refill()
+            self.level = min(self.level, remaining)
+
+
+class RedisTokenBucket:
+    """
+    Same as LocalTokenBucket, but shared between processes. Each operation is a single round trip running a Lua script,
+    so it's atomic. If Redis can't be reached, operations go to a LocalTokenBucket instead for REDIS_RETRY_INTERVAL.
+    """
+
+    SCRIPT = """
+    local capacity = tonumber(ARGV[1])
+    local per_second = tonumber(ARGV[2])
+    local op = ARGV[3]
+    local amount = tonumber(ARGV[4])
+
+    local t = redis.call('TIME')
+    local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+    local state = redis.call('HMGET', KEYS[1], 'level', 'updated_at')
+    local level = tonumber(state[1]) or capacity
+    local updated_at = tonumber(state[2]) or now
+    level = math.min(capacity, level + (now - updated_at) * per_second)
+
+    if op == 'reserve' then
+        level = level - amount
+    elseif op == 'add' then
+        level = math.min(capacity, level + amount)
+    elseif op == 'cap' then
+        level = math.min(level, amount)
+    end
+
+    redis.call('HSET', KEYS[1], 'level', tostring(level), 'updated_at', tostring(now))
+    redis.call('EXPIRE', KEYS[1], 3600)
+    -- Lua numbers are truncated to integers in replies, so return a string
+    return tostring(math.max(0, -level / per_second))
+    """
+
+    def __init__(self, client, key, capacity, per_second):
+        self.key = key
+        self.capacity = capacity
+        self.per_second = per_second
+        self._script = client.register_script(self.SCRIPT)
+        self.fallback = LocalTokenBucket(capacity, per_second)
+        self._unavailable_until = 0
+
+    def _run(self, op, amount):
+        if time.monotonic() >= self._unavailable_until:
+            try:
+                return float(self._script(keys=[self.key], args=[self.capacity, self.per_second, op, amount]))
+            except redis.RedisError as e:
+                print(f"UserWarning: Can't reach Redis for GPT rate limits, limiting this process only for "
+                      f"{REDIS_RETRY_INTERVAL}s: {e}")
+                self._unavailable_until = time.monotonic() + REDIS_RETRY_INTERVAL
+        return getattr(self.fallback, op)(amount)
+
+    def reserve(self, amount):
+        return self._run('reserve', amount)
+
+    def add(self, amount):
+        self._run('add', amount)
+
+    def cap(self, remaining):
+        self._run('cap', remaining)
+
+
+class Reservation:
+    """
+    A request's share of the rate limits. Call update() with the response, so the buckets reflect what it actually used.
+    """
+
+    def __init__(self, limiter, n_tokens):
+        self.limiter = limiter
+        self.n_tokens = n_tokens
+
+    def update(self, headers=None, usage=None):
+        if usage is not None:
+            self.limiter.tokens.add(self.n_tokens - usage.total_tokens)
+            self.n_tokens = usage.total_tokens
+        self.limiter.update_from_headers(headers)
+
+    async def aupdate(self, headers=None, usage=None):
+        await self.limiter.run_async(self.update, headers, usage)
+
+
+class ModelLimiter:
+
+    def __init__(self, requests, tokens):
+        self.requests = requests
+        self.tokens = tokens
+        self.is_shared = isinstance(requests, RedisTokenBucket)
+
+    async def run_async(self, fn, *args):
+        # Redis round trips would block the event loop, so they run in a thread
+        if self.is_shared:
+            return await sync_to_async(fn, thread_sensitive=False)(*args)
+        return fn(*args)
+
+    def reserve(self, n_tokens):
+        # Returns how long to wait before sending the request
+        return max(self.requests.reserve(1), self.tokens.reserve(n_tokens))
+
+    def update_from_headers(self, headers):
+        remaining_requests = _get_header_int(headers, 'x-ratelimit-remaining-requests')
+        if remaining_requests is not None:
+            self.requests.cap(remaining_requests)
+        remaining_tokens = _get_header_int(headers, 'x-ratelimit-remaining-tokens')
+        if remaining_tokens is not None:
+            self.tokens.cap(remaining_tokens)
+
+    def on_rate_limited(self, headers):
+        # Whatever our estimate said, there's nothing left
+        self.requests.cap(0)
+        self.tokens.cap(0)
+        self.update_from_headers(headers)
+
+
+class GPTScheduler:
+
+    def __init__(self, rate_limits, max_concurrency, redis_url=None):
+        self.rate_limits = rate_limits
+        self.max_concurrency = max_concurrency
+        self.redis_url = redis_url
+        self._limiters = {}
+        self._lock = threading.Lock()
+        # asyncio primitives belong to one event loop, and async_to_sync runs each call in a new one
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def _make_bucket(self, model, kind, per_minute):
+        if self.redis_url:
+            # Doesn't connect yet, and falls back to a local bucket whenever Redis is unreachable
+            client = redis.Redis.from_url(self.redis_url, socket_timeout=1, socket_connect_timeout=1)
+            return RedisTokenBucket(client, f'gpt-rate-limit:{model}:{kind}', per_minute, per_minute / 60)
+        return LocalTokenBucket(per_minute, per_minute / 60)
+
+    def get_limiter(self, model):
+        with self._lock:
+            if model not in self._limiters:
+                limits = self.rate_limits.get(model, self.rate_limits['default'])
+                self._limiters[model] = ModelLimiter(
+                    requests=self._make_bucket(model, 'requests', limits['rpm']),
+                    tokens=self._make_bucket(model, 'tokens', limits['tpm']),
+                )
+            return self._limiters[model]
+
+    def _get_semaphore(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self._semaphores:
+            self._semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphores[loop]
+
+    @contextlib.asynccontextmanager
+    async def limit(self, model, messages):
+        """
+        Waits for a concurrency slot and enough rate limit budget for this request, and yields its Reservation.
+        """
+        limiter = self.get_limiter(model)
+        async with self._get_semaphore():
+            n_tokens = estimate_tokens(messages)
+            delay = await limiter.run_async(limiter.reserve, n_tokens)
+            if delay:
+                await asyncio.sleep(delay)
+            yield Reservation(limiter, n_tokens)
+
+    def limit_sync(self, model, messages):
+        limiter = self.get_limiter(model)
+        n_tokens = estimate_tokens(messages)
+        delay = limiter.reserve(n_tokens)
+        if delay:
+            time.sleep(delay)
+        return Reservation(limiter, n_tokens)
+
+    def on_rate_limited(self, model, headers, attempt):
+        """
+        Returns how long to wait before retrying a rate limited request.
+        """
+        self.get_limiter(model).on_rate_limited(headers)
+        return get_backoff(attempt, headers)
+
+    async def aon_rate_limited(self, model, headers, attempt):
+        return await self.get_limiter(model).run_async(self.on_rate_limited, model, headers, attempt)
+
+
+scheduler = GPTScheduler(
+    rate_limits=settings.OPENAI_RATE_LIMITS,
+    max_concurrency=settings.OPENAI_MAX_CONCURRENCY,
+    redis_url=settings.OPENAI_RATE_LIMIT_REDIS_URL,
+)
@@ -4,14 +4,18 @@ Uses the new structured outputs feature from OpenAI.
 
 import textwrap
 from django.conf import settings
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
+
+from mainapp.gpt_scheduler import scheduler
 
 # This is the latest that supports Structured Outputs at the time of writing
 DEFAULT_MODEL = "gpt-4o-2024-08-06"
 
-client = OpenAI(api_key=settings.OPENAI_API_KEY)
+# Retries are handled by callers, as in gpt.py, so the scheduler sees every rate limited response
+client = OpenAI(api_key=settings.OPENAI_API_KEY, max_retries=0)
+client_async = AsyncOpenAI(api_key=settings.OPENAI_API_KEY, max_retries=0)
 
-def get_response_structured(prompt, structure, model=DEFAULT_MODEL, temperature=None, show_prompt=False):
+def _get_args(prompt, structure, model, temperature, show_prompt):
 
     if isinstance(prompt, list):
         messages = prompt
@@ -33,6 +37,13 @@ def get_response_structured(prompt, structure, model=DEFAULT_MODEL, temperature=
     if show_prompt:
         print(prompt)
 
+    return args
+
+
+def get_response_structured(prompt, structure, model=DEFAULT_MODEL, temperature=None, show_prompt=False):
+
+    args = _get_args(prompt, structure, model, temperature, show_prompt)
+
     try:
         completion = client.beta.chat.completions.parse(**args)
         return completion.choices[0].message.parsed
@@ -43,3 +54,24 @@ def get_response_structured(prompt, structure, model=DEFAULT_MODEL, temperature=
 
 
 
+
+
+async def iter_response_structured_async(prompt, structure, model=DEFAULT_MODEL, temperature=None, show_prompt=False):
+    """
+    Streams the response, yielding (parsed, is_complete) as it arrives. Until the response is complete, parsed is a
+    dict of whatever JSON has been received so far (so the last value in it may be cut off). Once it's complete, parsed
+    is an instance of structure.
+    """
+    args = _get_args(prompt, structure, model, temperature, show_prompt)
+
+    try:
+        async with scheduler.limit(model, args['messages']):
+            async with client_async.beta.chat.completions.stream(**args) as stream:
+                async for event in stream:
+                    if event.type == 'content.delta' and event.parsed is not None:
+                        yield event.parsed, False
+                    elif event.type == 'content.done':
+                        yield event.parsed, True
+    except:
+        print("OpenAI request failed")
+        raise
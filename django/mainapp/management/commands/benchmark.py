@@ -0,0 +1,236 @@
+import os
+import re
+import time
+import tracemalloc
+
+import jieba
+import lxml.etree
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test.utils import CaptureQueriesContext
+from tabulate import tabulate
+
+from mainapp.models import Article, Annotation
+from mainapp.reading import ARTICLE_LENGTH_LIMIT, dictionary, jieba_dict, trie
+from mainapp.reading.annotate.phrases import _get_phrase_annotations, PHRASE_DELIMITERS, PHRASE_MAX_LENGTH
+from mainapp.reading.annotate.words import _split_words, _should_annotate, SEGMENTER_JIEBA, SEGMENTER_TRIE
+from mainapp.reading.document import ParsedDocument
+from mainapp.reading.utils import clean_article_body, iter_text, get_text
+from mainapp.utils import HANZI_PATTERN
+from mainapp.views.core import clean_sample_html, sample_news, sample_blogpost, sample_book
+
+SAMPLE_ARTICLES = {
+    'news': sample_news,
+    'blogpost': sample_blogpost,
+    'book': sample_book,
+}
+
+
+def _get_long_article():
+    # Join the sample articles' paragraphs until the plaintext reaches the maximum article length
+    paragraphs = []
+    length = 0
+    for html in SAMPLE_ARTICLES.values():
+        body = clean_article_body(clean_sample_html(html))
+        for paragraph in lxml.etree.fromstring(body):
+            if length < ARTICLE_LENGTH_LIMIT:
+                paragraphs.append(lxml.etree.tostring(paragraph, encoding='unicode'))
+                length += sum(len(text) for _, text in iter_text(paragraphs[-1]))
+    return f"<div>{''.join(paragraphs)}</div>"
+
+
+def _old_split_phrases(xml_string, i=0):
+    # How phrases were split before they were found by offset (see _split_phrases): by copying and re-parsing the XML
+    xml_string = xml_string.strip(''.join(PHRASE_DELIMITERS))
+
+    if not re.search(rf'[{HANZI_PATTERN}\d+]', xml_string):
+        return None
+
+    if i == len(PHRASE_DELIMITERS):
+        return [xml_string]
+
+    if i > 0 and len(get_text(xml_string)) <= PHRASE_MAX_LENGTH:
+        return [xml_string]
+
+    pattern = rf'[{re.escape(PHRASE_DELIMITERS[i])}]'
+    if i == 0:
+        pattern = '|'.join(f'(?:{p})' for p in [pattern, r'</?(?:p|div|li|ol|ul)>'])
+
+    if re.search(pattern, xml_string):
+        phrases = []
+        for xml_chunk in re.split(pattern, xml_string):
+            if xml_chunk:
+                chunk_phrases = _old_split_phrases(xml_chunk, i + 1)
+                if chunk_phrases:
+                    phrases += chunk_phrases
+        return phrases
+    else:
+        return _old_split_phrases(xml_string, i + 1)
+
+
+def _old_get_phrase_annotations(xml_string):
+    annotations = []
+    i = 0
+    for chunk in _old_split_phrases(xml_string) or []:
+        a_start = xml_string.find(chunk, i)
+        a_text = get_text(chunk)
+        if a_text:
+            a_context = get_text(xml_string[max(a_start - 30, 0):a_start + len(chunk) + 30])
+            annotations.append((a_start, len(chunk), a_text, a_context))
+        i = a_start + len(chunk)
+    return annotations
+
+
+def _timed(fn):
+    start = time.perf_counter()
+    res = fn()
+    return res, time.perf_counter() - start
+
+
+def _peak_memory(fn):
+    # tracemalloc slows allocation-heavy code down a lot, so this is kept separate from timing
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+class Command(BaseCommand):
+    help = "Benchmark parts of the reading pipeline on the sample articles"
+
+    def add_arguments(self, parser):
+        parser.add_argument('target', choices=['segmenters', 'phrases', 'reader_queries', 'annotation_writes'])
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--memory', action='store_true', help="Also measure peak memory while loading (slow)")
+        parser.add_argument('--article', type=int, help="Article pk for reader_queries and annotation_writes (default: the most annotated)")
+
+    def handle(self, *args, **options):
+        getattr(self, f"benchmark_{options['target']}")(**options)
+
+    def benchmark_segmenters(self, repeat, memory, **options):
+        dictionary.index.ensure_loaded()
+
+        _, jieba_load = _timed(jieba_dict.get_tokenizer)
+        _, trie_load = _timed(trie.get_segmenter)
+        rows = [[SEGMENTER_JIEBA, f'{jieba_load:.2f}s'], [SEGMENTER_TRIE, f'{trie_load:.2f}s']]
+        if memory:
+            # Load fresh copies, as the ones above are cached
+            key = jieba_dict.get_word_table_key()
+            has_user_dict = os.path.isfile(jieba_dict.get_dict_path(key))
+            tokenizer = jieba_dict._make_tokenizer(key) if has_user_dict else jieba.Tokenizer()
+            rows[0].append(f'{_peak_memory(tokenizer.initialize) / 1e6:.1f}MB')
+            words = dictionary.index.get_word_strings()
+            rows[1].append(f'{_peak_memory(lambda: trie.TrieSegmenter(words)) / 1e6:.1f}MB')
+        self.stdout.write(tabulate(rows, headers=['engine', 'load', 'peak memory']))
+        self.stdout.write('')
+
+        rows = []
+        for name, html in SAMPLE_ARTICLES.items():
+            texts = [text for _, text in iter_text(clean_article_body(clean_sample_html(html)))]
+            n_hanzi = sum(1 for text in texts for c in text if _should_annotate(c))
+            for engine in [SEGMENTER_JIEBA, SEGMENTER_TRIE]:
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    words = [w for text in texts for w in _split_words(text, engine=engine)]
+                elapsed = (time.perf_counter() - start) / repeat
+
+                # Characters covered by a multi-character token we can annotate as a Word
+                n_in_words = sum(
+                    len(w) for w in words
+                    if len(w) > 1 and _should_annotate(w) and dictionary.index.contains(w)
+                )
+                rows.append([
+                    name, engine, f'{elapsed * 1000:.1f}ms', len(words), f'{n_in_words / n_hanzi:.0%}',
+                ])
+
+        self.stdout.write(tabulate(rows, headers=['article', 'engine', 'time', 'tokens', 'hanzi in words']))
+
+    def benchmark_phrases(self, repeat, **options):
+        # The whole split-and-extract step of annotate_phrases_with_placeholders, before and after, on the same article
+        xml_string = _get_long_article()
+        doc = ParsedDocument(xml_string)
+
+        rows = []
+        for name, fn in [
+            ('old: split copies + beautifulsoup', lambda: _old_get_phrase_annotations(xml_string)),
+            ('new: split offsets + get_text', lambda: _get_phrase_annotations(ParsedDocument(xml_string))),
+        ]:
+            annotations = fn()
+            start = time.perf_counter()
+            for _ in range(repeat):
+                fn()
+            rows.append([name, len(annotations), f'{(time.perf_counter() - start) / repeat * 1000:.1f}ms'])
+
+        self.stdout.write(f"{len(doc.plaintext)} plaintext characters")
+        self.stdout.write(tabulate(rows, headers=['phrases', 'count', 'time']))
+
+    def _get_benchmark_article(self, article):
+        articles = Article.objects.annotate(n_annotations=Count('annotation'))
+        article = articles.filter(pk=article).first() if article else articles.order_by('-n_annotations').first()
+        if article is None:
+            raise CommandError("No article to benchmark")
+        return article
+
+    def benchmark_reader_queries(self, repeat, article, **options):
+        article = self._get_benchmark_article(article)
+
+        def with_instances():
+            # What the reader API used to do: full model instances, with CPs de-duplicated in Python
+            return (
+                {w.pk: w.client_obj for w in article.get_words()},
+                {cp.pk: cp.client_obj for cp in article.get_cps()},
+                {p.pk: p.compute_client_obj() for p in article.get_phrases()},
+            )
+
+        def with_values():
+            return (
+                dict(article.get_word_client_objs()),
+                dict(article.get_cp_client_objs()),
+                dict(article.get_phrase_client_objs()),
+            )
+
+        if with_instances() != with_values():
+            raise CommandError("Query paths returned different results")
+
+        rows = []
+        for name, fn in [('model instances', with_instances), ('values_list', with_values)]:
+            with CaptureQueriesContext(connection) as queries:
+                fn()
+            start = time.perf_counter()
+            for _ in range(repeat):
+                fn()
+            rows.append([name, len(queries), f'{(time.perf_counter() - start) / repeat * 1000:.1f}ms'])
+
+        words, cps, phrases = with_values()
+        self.stdout.write(f"Article {article.pk}: {article.n_annotations} annotations, {len(words)} words, "
+                          f"{len(cps)} CPs, {len(phrases)} phrases")
+        self.stdout.write(tabulate(rows, headers=['query path', 'queries', 'time']))
+
+    def benchmark_annotation_writes(self, repeat, article, **options):
+        article = self._get_benchmark_article(article)
+        attnames = [f.attname for f in Annotation._meta.concrete_fields if not f.primary_key]
+        rows = list(Annotation.objects.filter(
+            article=article,
+            type__in=[Annotation.TYPE_WORD, Annotation.TYPE_CHARACTER],
+        ).values_list(*attnames))
+
+        def write(insert):
+            # Rewrite the article's word/CP annotations repeat times over, then roll back
+            with transaction.atomic():
+                Annotation.objects.delete_words(article)
+                for _ in range(repeat):
+                    insert()
+                transaction.set_rollback(True)
+
+        results = []
+        for name, insert in [
+            ('bulk_create', lambda: Annotation.objects.bulk_create([Annotation(**dict(zip(attnames, row))) for row in rows])),
+            ('COPY', lambda: Annotation.objects.copy_insert_values(attnames, rows)),
+        ]:
+            _, elapsed = _timed(lambda: write(insert))
+            results.append([name, f'{elapsed / repeat * 1000:.1f}ms'])
+
+        self.stdout.write(f"Article {article.pk}: {len(rows)} word/CP annotations")
+        self.stdout.write(tabulate(results, headers=['insert', 'time']))
@@ -0,0 +1,21 @@
+import glob
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from mainapp.reading import jieba_dict
+
+
+class Command(BaseCommand):
+    help = "Build the jieba user dictionary (and its prefix dictionary cache) from the Word table"
+
+    def handle(self, *args, **options):
+        key, n_entries = jieba_dict.build_user_dict()
+        self.stdout.write(f"Wrote {n_entries} entries to {jieba_dict.get_dict_path(key)}")
+
+        # Dictionaries for older versions of the Word table are never loaded again
+        for path in glob.glob(os.path.join(settings.JIEBA_DICT_DIR, 'words.*')):
+            if f'.{key}.' not in os.path.basename(path):
+                os.remove(path)
+                self.stdout.write(f"Removed {path}")
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from mainapp.models import Article, Annotation, PackedAnnotations
+
+
+class Command(BaseCommand):
+    help = "Convert existing articles' Word and CP annotations to PackedAnnotations blobs (or back to rows with --unpack)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--unpack', action='store_true', help="Convert packed annotations back to Annotation rows")
+        parser.add_argument('--articles', type=int, nargs='+', help="Only convert these articles (default: all of them)")
+
+    def handle(self, *args, unpack, articles, **options):
+        if unpack:
+            article_pks = PackedAnnotations.objects.values_list('article_id', flat=True)
+        else:
+            article_pks = Article.objects.filter(
+                annotation__type__in=[Annotation.TYPE_WORD, Annotation.TYPE_CHARACTER],
+            ).values_list('pk', flat=True).distinct()
+        if articles:
+            article_pks = article_pks.filter(**{'article_id__in' if unpack else 'pk__in': articles})
+        article_pks = sorted(article_pks)
+
+        n_annotations = 0
+        for i, article_pk in enumerate(article_pks):
+            # One transaction per article, so the reader never sees an article with no annotations
+            with transaction.atomic():
+                annotations = Annotation.objects.get_word_annotation_values(article_pk)
+                Annotation.objects.replace_word_annotations(article_pk, annotations, packed=not unpack)
+            n_annotations += len(annotations)
+            self.stdout.write(f"{i + 1}/{len(article_pks)}: article {article_pk}, {len(annotations)} annotations")
+
+        self.stdout.write(f"{'Unpacked' if unpack else 'Packed'} {n_annotations} annotations in {len(article_pks)} articles")
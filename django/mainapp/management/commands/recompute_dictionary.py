@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from mainapp.models import Word, CharacterPinyin, ReaderPayload
+
+
+class Command(BaseCommand):
+    help = "Recompute the cached fields (client_obj etc) of Words and CharacterPinyins, in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('target', choices=['words', 'cps', 'all'])
+        parser.add_argument('--pks', type=int, nargs='+', help="Only recompute these (default: all of them)")
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def get_progress(self, label):
+        start = time.perf_counter()
+
+        def progress(n_done, n_total):
+            elapsed = time.perf_counter() - start
+            rate = n_done / elapsed if elapsed else 0
+            eta = (n_total - n_done) / rate if rate else 0
+            self.stdout.write(f"{label}: {n_done}/{n_total} ({n_done / n_total:.0%}), {rate:.0f}/s, {eta:.0f}s left")
+        return progress
+
+    def handle(self, *args, target, pks, batch_size, **options):
+        if target in ['cps', 'all']:
+            n = CharacterPinyin.objects.recompute_client_objs(pks, batch_size, self.get_progress('CPs'))
+            self.stdout.write(f"Recomputed {n} CPs")
+        if target in ['words', 'all']:
+            n = Word.objects.recompute_cached_fields(pks, batch_size, self.get_progress('Words'))
+            self.stdout.write(f"Recomputed {n} words")
+
+        # Reader payloads include the client_objs of every word and CP in the article
+        ReaderPayload.objects.invalidate_all()
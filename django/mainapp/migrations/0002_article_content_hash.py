@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:37
+
+import xxhash
+from django.db import migrations, models
+
+
+def set_content_hashes(apps, schema_editor):
+    # Same as reading.dedupe.get_content_hash, so existing articles can be reused
+    Article = apps.get_model('mainapp', 'Article')
+    articles = list(Article.objects.only('pk', 'title', 'body'))
+    for article in articles:
+        article.content_hash = xxhash.xxh64(f"{article.title or ''}\n\n{article.body or ''}".encode()).hexdigest()
+    Article.objects.bulk_update(articles, ['content_hash'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainapp', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='article',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, help_text='Hash of the title and cleaned body, for reusing the results of processing an identical article', max_length=16, null=True),
+        ),
+        migrations.RunPython(set_content_hashes, migrations.RunPython.noop),
+    ]
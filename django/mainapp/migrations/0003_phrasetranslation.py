@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainapp', '0002_article_content_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PhraseTranslation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(help_text='Hash of the normalised prompt inputs and model', max_length=16, unique=True)),
+                ('english', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('n_hits', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+    ]
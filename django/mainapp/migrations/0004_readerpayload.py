@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:47
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainapp', '0003_phrasetranslation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReaderPayload',
+            fields=[
+                ('article', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='mainapp.article')),
+                ('version', models.PositiveIntegerField(default=0, help_text='Incremented every time the payload is invalidated')),
+                ('payload', models.TextField(blank=True, help_text='JSON, or null if it needs rebuilding', null=True)),
+                ('etag', models.CharField(blank=True, max_length=16, null=True)),
+            ],
+        ),
+    ]
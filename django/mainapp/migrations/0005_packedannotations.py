@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:01
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainapp', '0004_readerpayload'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PackedAnnotations',
+            fields=[
+                ('article', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='mainapp.article')),
+                ('data', models.BinaryField()),
+            ],
+        ),
+    ]
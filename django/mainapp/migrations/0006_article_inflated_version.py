@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainapp', '0005_packedannotations'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='article',
+            name='inflated_version',
+            field=models.PositiveIntegerField(default=0, help_text='Bumped whenever the inflated XML changes, so it can be cached when rendered on request instead (see settings.LAZY_INFLATION)'),
+        ),
+    ]
@@ -7,9 +7,11 @@ from .core import \
     Word, \
     WordChar, \
     Definition, \
-    Meaning
+    Meaning, \
+    DictionaryVersion
 
-from .articles import Article, Annotation, PhraseAnnotation
+from .articles import Article, Annotation, PhraseAnnotation, PhraseTranslation, ReaderPayload, \
+    PackedAnnotations
 
 
 from django.db import transaction
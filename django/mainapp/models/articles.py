@@ -1,11 +1,15 @@
+import io
 import string
 import secrets
+import sys
+from array import array
 
 from django.conf import settings
-from django.db import models
+from django.db import connections, models, transaction
+from django.db.models import Q
 from django.urls import reverse
 
-from mainapp.models import Word, CharacterPinyin
+from mainapp.models import Word, WordChar, CharacterPinyin
 
 
 def generate_uuid():
@@ -18,6 +22,68 @@ def generate_uuid():
     return random_string
 
 
+class ArticleManager(models.Manager):
+    """
+    The reader API only needs (pk, client_obj) for each word, CP and phrase in an article, so these fetch exactly that
+    with one query each. Rows are de-duplicated in SQL, by selecting pk IN (ids annotated in the article).
+    """
+
+    def _get_packed_word_and_cp_pks(self, article_pk):
+        # Returns (word_pks, cp_pks) if the article's annotations are packed, else None
+        data = PackedAnnotations.objects.filter(article_id=article_pk).values_list('data', flat=True).first()
+        if data is None:
+            return None
+        annotations = PackedAnnotations.unpack(data)
+        return (
+            {word_pk for _, _, _, word_pk, _ in annotations if word_pk},
+            {cp_pk for _, _, _, _, cp_pk in annotations if cp_pk},
+        )
+
+    def get_word_client_objs(self, article_pk):
+        packed_pks = self._get_packed_word_and_cp_pks(article_pk)
+        if packed_pks:
+            return self.get_word_client_objs_for(packed_pks[0])
+
+        return Word.objects.filter(
+            pk__in=Annotation.objects.filter(
+                article_id=article_pk,
+                type=Annotation.TYPE_WORD,
+            ).values('word_id')
+        ).values_list('pk', 'client_obj')
+
+    def get_cp_client_objs(self, article_pk):
+        packed_pks = self._get_packed_word_and_cp_pks(article_pk)
+        if packed_pks:
+            return self.get_cp_client_objs_for(*packed_pks)
+
+        # CPs annotated directly, UNION the CPs making up each annotated word
+        cp_ids = Annotation.objects.filter(
+            article_id=article_pk,
+            type=Annotation.TYPE_CHARACTER,
+        ).order_by().values('cp_id').union(WordChar.objects.filter(
+            word__annotation__article_id=article_pk,
+            word__annotation__type=Annotation.TYPE_WORD,
+        ).order_by().values('character_pinyin_id'))
+        return CharacterPinyin.objects.filter(pk__in=cp_ids).values_list('pk', 'client_obj')
+
+    def get_word_client_objs_for(self, word_pks):
+        return Word.objects.filter(pk__in=word_pks).values_list('pk', 'client_obj')
+
+    def get_cp_client_objs_for(self, word_pks, cp_pks):
+        # These CPs, and the CPs making up these words
+        return CharacterPinyin.objects.filter(
+            Q(pk__in=cp_pks) |
+            Q(pk__in=WordChar.objects.filter(word_id__in=word_pks).order_by().values('character_pinyin_id'))
+        ).values_list('pk', 'client_obj')
+
+    def get_phrase_client_objs(self, article_pk):
+        phrases = PhraseAnnotation.objects.filter(
+            annotation__article_id=article_pk,
+            annotation__type=Annotation.TYPE_PHRASE,
+        ).values_list('pk', 'english')
+        return [(pk, PhraseAnnotation.make_client_obj(pk, english)) for pk, english in phrases]
+
+
 class Article(models.Model):
 
     created_at = models.DateTimeField(auto_now_add=True)
@@ -33,7 +99,11 @@ class Article(models.Model):
 
     # Cached
     inflated = models.TextField(null=True, blank=True, help_text="Inflated XML, including the Chinese title")
+    inflated_version = models.PositiveIntegerField(default=0, help_text="Bumped whenever the inflated XML changes, so it can be cached when rendered on request instead (see settings.LAZY_INFLATION)")
     plaintext = models.TextField(null=True, blank=True, help_text="Title and body, stripped of all HTML tags")
+    content_hash = models.CharField(max_length=16, null=True, blank=True, db_index=True, help_text="Hash of the title and cleaned body, for reusing the results of processing an identical article")
+
+    objects = ArticleManager()
 
     class Meta:
         unique_together = ('user', 'title')
@@ -87,6 +157,15 @@ class Article(models.Model):
             annotation__type=Annotation.TYPE_PHRASE,
         ).distinct()
 
+    def get_word_client_objs(self):
+        return Article.objects.get_word_client_objs(self.pk)
+
+    def get_cp_client_objs(self):
+        return Article.objects.get_cp_client_objs(self.pk)
+
+    def get_phrase_client_objs(self):
+        return Article.objects.get_phrase_client_objs(self.pk)
+
 
 class PhraseAnnotation(models.Model):
     text = models.TextField(help_text="The plain text of this phrase, without any HTML")
@@ -99,12 +178,217 @@ class PhraseAnnotation(models.Model):
 
 
     def compute_client_obj(self):
+        return self.make_client_obj(self.pk, self.english)
+
+    @staticmethod
+    def make_client_obj(pk, english):
         return {
-            'pk': self.pk,
-            'english': self.english,
+            'pk': pk,
+            'english': english,
         }
 
 
+class PhraseTranslation(models.Model):
+    """
+    A cached GPT phrase translation, see reading/annotate/translation_cache.py
+    """
+    key = models.CharField(max_length=16, unique=True, help_text="Hash of the normalised prompt inputs and model")
+    english = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    n_hits = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.english}'
+
+
+class ReaderPayloadManager(models.Manager):
+
+    def invalidate(self, article_pk):
+        """
+        Call this whenever anything in the article's reader payload changes (annotations, phrase translations, summary
+        or inflated XML). Bumping the version also stops a payload built from the old data being saved afterwards.
+        """
+        self.filter(article_id=article_pk).update(version=models.F('version') + 1, payload=None, etag=None)
+
+    def invalidate_all(self):
+        # For changes that could affect any article, like recomputing the dictionary's client_objs
+        self.update(version=models.F('version') + 1, payload=None, etag=None)
+
+    async def ainvalidate(self, article_pk):
+        await self.filter(article_id=article_pk).aupdate(version=models.F('version') + 1, payload=None, etag=None)
+
+
+class ReaderPayload(models.Model):
+    """
+    The serialized response of the reader API for an article, so repeat loads don't rebuild it, see
+    views/api/article_reader.py
+    """
+    article = models.OneToOneField(Article, on_delete=models.CASCADE, primary_key=True)
+    version = models.PositiveIntegerField(default=0, help_text="Incremented every time the payload is invalidated")
+    payload = models.TextField(null=True, blank=True, help_text="JSON, or null if it needs rebuilding")
+    etag = models.CharField(max_length=16, null=True, blank=True)
+
+    objects = ReaderPayloadManager()
+
+
+def _copy_text_value(value):
+    # A value in COPY's text format
+    if value is None:
+        return '\\N'
+    if isinstance(value, str):
+        return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+    return str(value)
+
+
+class AnnotationManager(models.Manager):
+
+    def copy_insert(self, annotations):
+        """
+        Inserts unsaved Annotations with Postgres COPY, which is much faster than INSERT ... VALUES for thousands of
+        rows. Unlike bulk_create, this doesn't set their pks.
+        """
+        attnames = [f.attname for f in self.model._meta.concrete_fields if not f.primary_key]
+        self.copy_insert_values(attnames, ([getattr(a, attname) for attname in attnames] for a in annotations))
+
+    def copy_insert_values(self, attnames, rows):
+        """
+        Like copy_insert, but takes rows of plain values (ints, strings or None) for the fields in attnames, which saves
+        building an Annotation for each.
+        """
+        connection = connections[self.db]
+        if connection.vendor != 'postgresql':
+            return self.bulk_create([self.model(**dict(zip(attnames, row))) for row in rows])
+
+        data = io.StringIO()
+        for row in rows:
+            data.write('\t'.join(map(_copy_text_value, row)) + '\n')
+        data.seek(0)
+
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        columns = ', '.join(connection.ops.quote_name(self.model._meta.get_field(x).column) for x in attnames)
+        sql = f"COPY {table} ({columns}) FROM STDIN"
+        with connection.cursor() as cursor:
+            if hasattr(cursor.cursor, 'copy_expert'):
+                # psycopg2
+                cursor.cursor.copy_expert(sql, data)
+            else:
+                with cursor.cursor.copy(sql) as copy:
+                    copy.write(data.getvalue())
+
+    def delete_phrases(self, article):
+        """
+        Deletes the article's phrase Annotations and their PhraseAnnotations with one DELETE each. Unlike
+        QuerySet.delete(), this doesn't fetch the rows to send post_delete for each of them - the only receiver,
+        delete_phrase_annotation, would just delete the PhraseAnnotations deleted here anyway.
+        """
+        with transaction.atomic():
+            annotations = self.filter(article=article, type=Annotation.TYPE_PHRASE)
+            phrase_pks = list(annotations.exclude(phrase=None).values_list('phrase_id', flat=True))
+            n_deleted = annotations._raw_delete(annotations.db)
+            phrases = PhraseAnnotation.objects.filter(pk__in=phrase_pks)
+            phrases._raw_delete(phrases.db)
+        return n_deleted
+
+    def delete_words(self, article):
+        """
+        Deletes the article's Word and CP annotations with one DELETE, see delete_phrases.
+        """
+        annotations = self.filter(article=article, type__in=[Annotation.TYPE_WORD, Annotation.TYPE_CHARACTER])
+        return annotations._raw_delete(annotations.db)
+
+    # Word and CP annotations are stored either as rows, or packed into a PackedAnnotations (see
+    # settings.PACK_WORD_ANNOTATIONS). Everything else should go through these two methods, which handle both.
+
+    def get_word_annotation_values(self, article_pk, field=None, spans=None):
+        """
+        Returns (start, length, type, word_pk, cp_pk) for each of the article's Word and CP annotations, ordered by
+        start. If spans is given, only the annotations starting inside one of those (start, end) spans.
+        """
+        field = field or Annotation.FIELD_BODY
+        data = PackedAnnotations.objects.filter(article_id=article_pk).values_list('data', flat=True).first()
+        if data is not None:
+            # Word and CP annotations are always in the body. The blob has to be read whole, so filter it here.
+            values = PackedAnnotations.unpack(data) if field == Annotation.FIELD_BODY else []
+            if spans is not None:
+                values = [x for x in values if any(start <= x[0] < end for start, end in spans)]
+            return values
+
+        annotations = self.filter(
+            article_id=article_pk,
+            field=field,
+            type__in=[Annotation.TYPE_WORD, Annotation.TYPE_CHARACTER],
+        )
+        if spans is not None:
+            in_spans = Q()
+            for start, end in spans:
+                in_spans |= Q(start__gte=start, start__lt=end)
+            annotations = annotations.filter(in_spans)
+        return list(annotations.order_by('start').values_list('start', 'length', 'type', 'word_id', 'cp_id'))
+
+    def get_last_word_annotation_value(self, article_pk, field=None):
+        """
+        Returns (start, length, type, word_pk, cp_pk) for the article's Word or CP annotation that starts last, or None.
+        """
+        field = field or Annotation.FIELD_BODY
+        data = PackedAnnotations.objects.filter(article_id=article_pk).values_list('data', flat=True).first()
+        if data is not None:
+            values = PackedAnnotations.unpack(data) if field == Annotation.FIELD_BODY else []
+            return values[-1] if values else None
+
+        return self.filter(
+            article_id=article_pk,
+            field=field,
+            type__in=[Annotation.TYPE_WORD, Annotation.TYPE_CHARACTER],
+        ).order_by('-start').values_list('start', 'length', 'type', 'word_id', 'cp_id').first()
+
+    def replace_word_annotations(self, article_pk, annotations, packed=None, spans=None):
+        """
+        Replaces the article's Word and CP annotations with (start, length, type, word_pk, cp_pk) annotations in the
+        body, stored packed or as rows according to settings.PACK_WORD_ANNOTATIONS unless packed is given. If spans is
+        given, only the annotations starting inside one of those (start, end) spans are replaced, and they're stored
+        however the article's annotations already are.
+        """
+        with transaction.atomic():
+            if spans is not None:
+                packed_annotations = PackedAnnotations.objects.select_for_update().filter(article_id=article_pk)
+                data = packed_annotations.values_list('data', flat=True).first()
+                if data is not None:
+                    kept = [
+                        x for x in PackedAnnotations.unpack(data)
+                        if not any(start <= x[0] < end for start, end in spans)
+                    ]
+                    packed_annotations.update(data=PackedAnnotations.pack(kept + list(annotations)))
+                    return
+
+                in_spans = Q()
+                for start, end in spans:
+                    in_spans |= Q(start__gte=start, start__lt=end)
+                to_delete = self.filter(
+                    in_spans,
+                    article_id=article_pk,
+                    field=Annotation.FIELD_BODY,
+                    type__in=[Annotation.TYPE_WORD, Annotation.TYPE_CHARACTER],
+                )
+                to_delete._raw_delete(to_delete.db)
+                packed = False
+            else:
+                packed = settings.PACK_WORD_ANNOTATIONS if packed is None else packed
+                self.delete_words(article_pk)
+                PackedAnnotations.objects.filter(article_id=article_pk).delete()
+
+            if packed:
+                PackedAnnotations.objects.create(article_id=article_pk, data=PackedAnnotations.pack(annotations))
+            else:
+                self.copy_insert_values(
+                    ['article_id', 'field', 'type', 'start', 'length', 'word_id', 'cp_id'],
+                    (
+                        (article_pk, Annotation.FIELD_BODY, annotation_type, start, length, word_pk, cp_pk)
+                        for start, length, annotation_type, word_pk, cp_pk in annotations
+                    ),
+                )
+
+
 class Annotation(models.Model):
     TYPE_CHARACTER = 'CH'
     TYPE_WORD = 'WO'
@@ -134,9 +418,11 @@ class Annotation(models.Model):
     cp = models.ForeignKey(CharacterPinyin, on_delete=models.CASCADE, blank=True, null=True)
     phrase = models.OneToOneField(PhraseAnnotation, on_delete=models.CASCADE, blank=True, null=True)
 
+    objects = AnnotationManager()
+
     class Meta:
         indexes = [
-            # Composite index to speed up the delete query in annotate.py:save_annotations_for_chunk
+            # Composite index to speed up fetching and deleting an article's annotations of one type
             models.Index(fields=['article', 'type', 'start'], name='article_type_start_idx'),
         ]
 
@@ -146,3 +432,45 @@ class Annotation(models.Model):
         return self.start + self.length
 
 
+class PackedAnnotations(models.Model):
+    """
+    An article's Word and CP annotations packed into one blob, rather than a row each. This is four int32 arrays (start,
+    length, type and Word/CP pk), little-endian, one after another and ordered by start. Unlike Annotation rows, nothing
+    cascades here when a Word or CP is deleted, so readers should skip pks that no longer exist.
+    """
+    TYPE_CODES = {
+        Annotation.TYPE_WORD: 0,
+        Annotation.TYPE_CHARACTER: 1,
+    }
+
+    article = models.OneToOneField(Article, on_delete=models.CASCADE, primary_key=True)
+    data = models.BinaryField()
+
+    @classmethod
+    def pack(cls, annotations):
+        annotations = sorted(annotations)
+        values = array('i')
+        assert values.itemsize == 4
+        values.extend(start for start, _, _, _, _ in annotations)
+        values.extend(length for _, length, _, _, _ in annotations)
+        values.extend(cls.TYPE_CODES[annotation_type] for _, _, annotation_type, _, _ in annotations)
+        values.extend(word_pk or cp_pk for _, _, _, word_pk, cp_pk in annotations)
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return values.tobytes()
+
+    @classmethod
+    def unpack(cls, data):
+        if sys.byteorder == 'little':
+            # No copying, the arrays are read straight out of the buffer
+            values = memoryview(data).cast('B').cast('i')
+        else:
+            values = array('i', bytes(data))
+            values.byteswap()
+        n = len(values) // 4
+        starts, lengths, types, pks = (values[i * n:(i + 1) * n] for i in range(4))
+        return [
+            (start, length, Annotation.TYPE_WORD, pk, None) if type_code == 0 else
+            (start, length, Annotation.TYPE_CHARACTER, None, pk)
+            for start, length, type_code, pk in zip(starts, lengths, types, pks)
+        ]
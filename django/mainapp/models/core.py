@@ -2,13 +2,84 @@ import re
 
 from django.contrib.postgres.fields import ArrayField
 from django.db.models import JSONField
-from django.db import models
-from django.db.models import Min, Q
+from django.db import connections, models, router, transaction
+from django.db.models import Min, Prefetch, Q
+from django.dispatch import Signal
 
 from mainapp.pinyin import add_tone_mark, parse_pinyin, normalise_pinyin, is_valid_pinyin
 
 from mainapp.utils import HANZI_PATTERN
 
+def _iter_pk_batches(queryset, batch_size):
+    # Pages by pk rather than offset, so each batch is an index range scan however far through we are
+    last_pk = None
+    while True:
+        batch = queryset.order_by('pk')
+        if last_pk is not None:
+            batch = batch.filter(pk__gt=last_pk)
+        pks = list(batch.values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return
+        yield pks
+        last_pk = pks[-1]
+
+
+def _bulk_update_from_values(objs, field_names):
+    """
+    Like QuerySet.bulk_update, but as one UPDATE ... FROM (VALUES ...) statement. bulk_update's CASE WHEN pk = ...
+    per field is slow for Django to build and for Postgres to run once there are more than a few hundred objects.
+    """
+    if not objs:
+        return
+    model = type(objs[0])
+    connection = connections[router.db_for_write(model)]
+    qn = connection.ops.quote_name
+    fields = [model._meta.pk] + [model._meta.get_field(name) for name in field_names]
+
+    row_sql = '(' + ', '.join(f'%s::{field.db_type(connection)}' for field in fields) + ')'
+    params = [
+        field.get_db_prep_save(getattr(obj, field.attname), connection)
+        for obj in objs
+        for field in fields
+    ]
+    table = qn(model._meta.db_table)
+    columns = ', '.join(qn(field.column) for field in fields)
+    assignments = ', '.join(f'{qn(field.column)} = v.{qn(field.column)}' for field in fields[1:])
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"UPDATE {table} SET {assignments} FROM (VALUES {', '.join([row_sql] * len(objs))}) AS v({columns}) "
+            f"WHERE {table}.{qn(fields[0].column)} = v.{qn(fields[0].column)}",
+            params,
+        )
+
+
+# Sent by WordManager.bulk_create_from_chars with the created words and CPs, since bulk_create doesn't send post_save
+words_bulk_created = Signal()
+
+
+class CharacterPinyinManager(models.Manager):
+
+    def recompute_client_objs(self, pks=None, batch_size=1000, progress=None):
+        """
+        Recomputes client_obj for the CPs with the given pks (or all of them), batch_size at a time, with two queries to
+        load each batch and one to save it. Calls progress(n_done, n_total) after each batch.
+        """
+        queryset = self.all() if pks is None else self.filter(pk__in=pks)
+        n_total = queryset.count()
+        n_done = 0
+        for batch_pks in _iter_pk_batches(queryset, batch_size):
+            cps = list(self.filter(pk__in=batch_pks).select_related('character', 'pinyin', 'meaning').prefetch_related(
+                Prefetch('meaning__definition_set', queryset=Definition.objects.order_by('order'), to_attr='loaded_definitions'),
+            ).defer('client_obj'))
+            for cp in cps:
+                cp.client_obj = cp.compute_client_obj(cp.meaning.loaded_definitions if cp.meaning else [])
+            _bulk_update_from_values(cps, ['client_obj'])
+
+            n_done += len(cps)
+            if progress:
+                progress(n_done, n_total)
+        return n_done
+
 
 class CharacterPinyin(models.Model):
     character = models.ForeignKey('Character', on_delete=models.CASCADE)
@@ -19,6 +90,8 @@ class CharacterPinyin(models.Model):
     # Cached
     client_obj = JSONField(null=True, blank=True)
 
+    objects = CharacterPinyinManager()
+
     class Meta:
         unique_together = ('character', 'pinyin',)
 
@@ -29,7 +102,9 @@ class CharacterPinyin(models.Model):
     def char_string(self):
         return self.character.char
 
-    def compute_client_obj(self):
+    def compute_client_obj(self, definitions=None):
+        if definitions is None:
+            definitions = Definition.objects.filter(meaning_id=self.meaning_id).order_by('order') if self.meaning_id else []
         return {
             'pk': self.pk,
             'isVerified': True,
@@ -38,7 +113,7 @@ class CharacterPinyin(models.Model):
             'chinese': self.character.char,
             'pinyin': self.pinyin.written,
             'tone': self.pinyin.tone,
-            'definitions': [x.text for x in self.meaning.definition_set.order_by('order')] if self.meaning else [],
+            'definitions': [x.text for x in definitions],
             'hskLevel': None,
             'freqRank': None,
         }
@@ -123,6 +198,24 @@ class PinyinManager(models.Manager):
             pinyin = Pinyin.objects.get(syllable=syllable, tone=tone)
         return pinyin
 
+    def get_from_strs(self, pinyin_strs):
+        """
+        Like get_from_str for many pinyin strings at once, in one query. Returns {pinyin_str: Pinyin}.
+        """
+        parsed = {x: parse_pinyin(x) for x in set(pinyin_strs)}
+        pinyins = {
+            (p.syllable.written, p.tone): p
+            for p in Pinyin.objects.filter(
+                syllable__written__in={s for s, _ in parsed.values()},
+            ).select_related('syllable')
+        }
+        res = {}
+        for pinyin_str, key in parsed.items():
+            if key not in pinyins:
+                raise Pinyin.DoesNotExist(f"Unknown pinyin: {pinyin_str}")
+            res[pinyin_str] = pinyins[key]
+        return res
+
 
 class Pinyin(models.Model):
     syllable = models.ForeignKey('Syllable', on_delete=models.CASCADE)
@@ -144,6 +237,140 @@ class Pinyin(models.Model):
         return f'{self.syllable.written}{self.tone}'
 
 
+class WordManager(models.Manager):
+
+    def bulk_create_from_chars(self, entries):
+        """
+        Creates a Word for each (char_string, pinyin_list, definition, tags) in entries, in one transaction and with a
+        fixed number of queries however many there are. Characters and Pinyins are fetched up front, missing CPs are
+        created, and the cached fields are computed from the objects in memory. Returns the words in the same order.
+        """
+        entries = [(char_string, list(pinyin_list), definition, tags) for char_string, pinyin_list, definition, tags in entries]
+        for char_string, pinyin_list, _, _ in entries:
+            assert len(char_string) == len(pinyin_list), (char_string, pinyin_list)
+            # Make sure there's no punctuation or weird stuff
+            assert re.match(rf'^[{HANZI_PATTERN}]+$', char_string), char_string
+            assert all((is_valid_pinyin(x) for x in pinyin_list)), pinyin_list
+        if not entries:
+            return []
+
+        characters = Character.objects.in_bulk({c for char_string, _, _, _ in entries for c in char_string}, field_name='char')
+        pinyins = Pinyin.objects.get_from_strs([x for _, pinyin_list, _, _ in entries for x in pinyin_list])
+        for char_string, _, _, _ in entries:
+            for c in char_string:
+                if c not in characters:
+                    raise Character.DoesNotExist(f"Unknown character: {c}")
+
+        pairs = {
+            (characters[c], pinyins[pinyin_str])
+            for char_string, pinyin_list, _, _ in entries
+            for c, pinyin_str in zip(char_string, pinyin_list)
+        }
+
+        with transaction.atomic():
+            cps = {
+                (cp.character_id, cp.pinyin_id): cp
+                for cp in CharacterPinyin.objects.filter(
+                    character__in={character for character, _ in pairs},
+                    pinyin__in={pinyin for _, pinyin in pairs},
+                ).select_related('character', 'pinyin')
+            }
+
+            # Allow CP creation. Another transaction may be creating the same CPs, so skip any that conflict and then
+            # select the ones we actually created, since ignore_conflicts leaves the objects without pks
+            missing = [(character, pinyin) for character, pinyin in pairs if (character.pk, pinyin.pk) not in cps]
+            CharacterPinyin.objects.bulk_create([
+                CharacterPinyin(character=character, pinyin=pinyin, client_obj=None)
+                for character, pinyin in missing
+            ], ignore_conflicts=True)
+            new_cps = []
+            if missing:
+                missing_pairs = Q()
+                for character, pinyin in missing:
+                    missing_pairs |= Q(character=character, pinyin=pinyin)
+                for cp in CharacterPinyin.objects.filter(missing_pairs).select_related('character', 'pinyin'):
+                    cps[cp.character_id, cp.pinyin_id] = cp
+                    if cp.client_obj is None:
+                        new_cps.append(cp)
+            for cp in new_cps:
+                cp.client_obj = cp.compute_client_obj()
+            CharacterPinyin.objects.bulk_update(new_cps, ['client_obj'])
+
+            meanings = Meaning.objects.bulk_create([Meaning() for _ in entries])
+            definitions = Definition.objects.bulk_create([
+                Definition(meaning=meaning, text=definition, order=0)
+                for meaning, (_, _, definition, _) in zip(meanings, entries)
+                if definition
+            ])
+            definitions = {x.meaning_id: [x] for x in definitions}
+
+            words, word_wordchars = [], []
+            for meaning, (char_string, pinyin_list, _, tags) in zip(meanings, entries):
+                word = Word(
+                    meaning=meaning,
+                    char_string=char_string,
+                    pinyin_string=' '.join(normalise_pinyin(x) for x in pinyin_list),
+                    tags=list(dict.fromkeys(tag for tag in tags or [] if tag)),
+                )
+                wordchars = [
+                    WordChar(
+                        word=word,
+                        character_pinyin=cps[characters[c].pk, pinyins[pinyin_str].pk],
+                        order=i,
+                    )
+                    for i, (c, pinyin_str) in enumerate(zip(char_string, pinyin_list))
+                ]
+                assert word.char_string == word.compute_char_string(wordchars)
+                assert word.pinyin_string == word.compute_pinyin_string(wordchars)
+
+                word.pinyin_slug = word.compute_pinyin_slug(wordchars)
+                word.pinyin_string_numeric = word.compute_pinyin_string_numeric(wordchars)
+                words.append(word)
+                word_wordchars.append(wordchars)
+
+            Word.objects.bulk_create(words)
+
+            # client_obj needs the pks
+            for word, wordchars in zip(words, word_wordchars):
+                word.client_obj = word.compute_client_obj(wordchars, definitions.get(word.meaning_id, []))
+            Word.objects.bulk_update(words, ['client_obj'])
+
+            WordChar.objects.bulk_create([wc for wordchars in word_wordchars for wc in wordchars])
+
+            words_bulk_created.send(sender=Word, words=words, cps=new_cps)
+
+        return words
+
+    def recompute_cached_fields(self, pks=None, batch_size=1000, progress=None):
+        """
+        Recomputes pinyin_string, pinyin_slug, pinyin_string_numeric and client_obj for the words with the given pks (or
+        all of them), batch_size at a time, with three queries to load each batch and one to save it. Calls
+        progress(n_done, n_total) after each batch.
+        """
+        queryset = self.all() if pks is None else self.filter(pk__in=pks)
+        n_total = queryset.count()
+        n_done = 0
+        for batch_pks in _iter_pk_batches(queryset, batch_size):
+            words = list(self.filter(pk__in=batch_pks).select_related('meaning').prefetch_related(
+                Prefetch('wordchar_set', queryset=WordChar.objects.select_related(
+                    'character_pinyin__character',
+                    'character_pinyin__pinyin',
+                ).defer('character_pinyin__client_obj').order_by('order'), to_attr='loaded_wordchars'),
+                Prefetch('meaning__definition_set', queryset=Definition.objects.order_by('order'), to_attr='loaded_definitions'),
+            ).defer('client_obj'))
+            for word in words:
+                word.pinyin_string = word.compute_pinyin_string(word.loaded_wordchars)
+                word.pinyin_slug = word.compute_pinyin_slug(word.loaded_wordchars)
+                word.pinyin_string_numeric = word.compute_pinyin_string_numeric(word.loaded_wordchars)
+                word.client_obj = word.compute_client_obj(word.loaded_wordchars, word.meaning.loaded_definitions)
+            _bulk_update_from_values(words, ['pinyin_string', 'pinyin_slug', 'pinyin_string_numeric', 'client_obj'])
+
+            n_done += len(words)
+            if progress:
+                progress(n_done, n_total)
+        return n_done
+
+
 class Word(models.Model):
 
     CN = 'CN'
@@ -165,6 +392,8 @@ class Word(models.Model):
     pinyin_slug = models.CharField(null=True, blank=True, max_length=100, db_index=True)
     client_obj = JSONField(null=True, blank=True)
 
+    objects = WordManager()
+
     class Meta:
         constraints = [
             models.UniqueConstraint(fields=['char_string', 'pinyin_string'], name='unique_char_pinyin'),
@@ -172,89 +401,56 @@ class Word(models.Model):
 
     @classmethod
     def create_from_chars(cls, char_string, pinyin_list, definition=None, tags=None):
-        assert len(char_string) == len(pinyin_list), (char_string, pinyin_list)
-        # Make sure there's no punctuation or weird stuff
-        assert re.match(rf'^[{HANZI_PATTERN}]+$', char_string), char_string
-        assert all((is_valid_pinyin(x) for x in pinyin_list)), pinyin_list
-
-        meaning = Meaning()
-        meaning.save()
-        if definition:
-            Definition.objects.create(
-                meaning=meaning,
-                text=definition,
-                order=0,
-            )
-
-        word = Word(
-            meaning=meaning,
-            char_string=char_string,
-            pinyin_string=' '.join(normalise_pinyin(x) for x in pinyin_list),
-        )
-        word.save()
-
-        if tags:
-            for tag in tags:
-                if tag and tag not in word.tags:
-                    word.tags.append(tag)
-            word.save()
-
-        # Fill the new Word object with WordChar
-        for i, (char, pinyin_str) in enumerate(zip(char_string, pinyin_list)):
-            character = Character.objects.get(char=char)
-            pinyin = Pinyin.objects.get_from_str(pinyin_str)
-            # Allow CP creation
-            cp, created = CharacterPinyin.objects.get_or_create(
-                character=character,
-                pinyin=pinyin,
-            )
-            if created:
-                cp.sources.append('article')
-                cp.client_obj = cp.compute_client_obj()
-                cp.save()
-
-            WordChar(
-                word=word,
-                character_pinyin=cp,
-                order=i,
-            ).save()
-        assert word.char_string == word.compute_char_string()
-        assert word.pinyin_string == word.compute_pinyin_string()
-
-        word.pinyin_slug = word.compute_pinyin_slug()
-        word.client_obj = word.compute_client_obj()  # Requires word.pinyin_slug
-        word.pinyin_string_numeric = word.compute_pinyin_string_numeric()
-        word.save()
-        return word
+        return cls.objects.bulk_create_from_chars([(char_string, pinyin_list, definition, tags)])[0]
 
     def __str__(self):
         return f"{self.char_string} {self.pinyin_string}"
 
-    def compute_char_string(self):
+    def get_wordchars(self):
+        return list(WordChar.objects.filter(word=self).select_related(
+            'character_pinyin__character',
+            'character_pinyin__pinyin',
+        ).order_by('order'))
+
+    # The compute_* methods take the word's WordChars if they're already loaded, otherwise they're fetched
+
+    def compute_char_string(self, wordchars=None):
+        if wordchars is None:
+            wordchars = self.get_wordchars()
         return ''.join([
             x.character_pinyin.character.char if x.character_pinyin else x.punctuation
-            for x in WordChar.objects.filter(word=self).order_by('order')
+            for x in wordchars
         ])
 
-    def compute_pinyin_string(self):
+    def compute_pinyin_string(self, wordchars=None):
+        if wordchars is None:
+            wordchars = self.get_wordchars()
         return ' '.join([
             x.character_pinyin.pinyin.written if x.character_pinyin else x.punctuation
-            for x in WordChar.objects.filter(word=self).order_by('order')
+            for x in wordchars
         ])
 
-    def compute_pinyin_string_numeric(self):
+    def compute_pinyin_string_numeric(self, wordchars=None):
+        if wordchars is None:
+            wordchars = self.get_wordchars()
         return ' '.join(
             x.character_pinyin.pinyin.written_numeric if x.character_pinyin else x.punctuation
-            for x in WordChar.objects.filter(word=self).order_by('order')
+            for x in wordchars
         )
 
-    def compute_pinyin_slug(self):
+    def compute_pinyin_slug(self, wordchars=None):
+        if wordchars is None:
+            wordchars = self.get_wordchars()
         return '-'.join(
             x.character_pinyin.pinyin.written
-            for x in WordChar.objects.filter(word=self).order_by('order') if x.character_pinyin
+            for x in wordchars if x.character_pinyin
         )
 
-    def compute_client_obj(self):
+    def compute_client_obj(self, wordchars=None, definitions=None):
+        if wordchars is None:
+            wordchars = self.get_wordchars()
+        if definitions is None:
+            definitions = Definition.objects.filter(meaning_id=self.meaning_id).order_by('order')
         return {
             'pk': self.pk,
             'isVerified': True,
@@ -264,17 +460,17 @@ class Word(models.Model):
             'tones': [
                 # 5 is for punctuation etc because `tones` and `chinese` lists need to be the same length
                 x.character_pinyin.pinyin.tone if x.character_pinyin else 5
-                for x in WordChar.objects.filter(word=self).order_by('order')
+                for x in wordchars
             ],
             'pinyin': [
                 x.character_pinyin.pinyin.written if x.character_pinyin else ''
-                for x in WordChar.objects.filter(word=self).order_by('order')
+                for x in wordchars
             ],
             # cps contains pks of CPs in this word, but it's not sufficient to reconstruct the word since some words
             # contain punctuation, therefore the above (chinese, tones, pinyin) are still necessary. (cps is necessary
             # because we need to render component CPs in the sidebar under the word info).
-            'cps': [wc.character_pinyin.pk for wc in self.wordchar_set.all().order_by('order') if wc.character_pinyin],
-            'definitions': [x.text for x in self.meaning.definition_set.order_by('order')],
+            'cps': [wc.character_pinyin.pk for wc in wordchars if wc.character_pinyin],
+            'definitions': [x.text for x in definitions],
             'hskLevel': None,
             'freqRank': None,
 
@@ -355,9 +551,22 @@ class Meaning(models.Model):
         return self.word_set.aggregate(Min('hsk_level'))['hsk_level__min']
 
 
+class DictionaryVersionManager(models.Manager):
 
+    def get_version(self):
+        return self.filter(pk=1).values_list('version', flat=True).first() or 0
 
+    def bump(self):
+        # Call this in the same transaction as the change, so no process sees the new version before the change itself
+        if not self.filter(pk=1).update(version=models.F('version') + 1):
+            self.get_or_create(pk=1, defaults={'version': 1})
 
 
+class DictionaryVersion(models.Model):
+    """
+    A single row, bumped whenever a Word or CP is created, changed or deleted, so every process knows to reload its
+    dictionary index (see reading/dictionary.py)
+    """
+    version = models.PositiveBigIntegerField(default=0)
 
-
+    objects = DictionaryVersionManager()
@@ -1,2 +1,3 @@
 from . import words
-from . import phrases
\ No newline at end of file
+from . import phrases
+from . import translation_cache
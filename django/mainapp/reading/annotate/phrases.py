@@ -1,11 +1,18 @@
 import re
 import asyncio
+import textwrap
 import traceback
 
-from mainapp import gpt
-from mainapp.models import Annotation
+from django.db import transaction
+from openai import RateLimitError
+from pydantic import BaseModel
+
+from mainapp import gpt, gpt_structured
+from mainapp.gpt_scheduler import scheduler
+from mainapp.models import Annotation, ReaderPayload
 from mainapp.models.articles import PhraseAnnotation
-from mainapp.reading.utils import iter_text, get_text
+from mainapp.reading.annotate import translation_cache
+from mainapp.reading.document import parse_article
 from mainapp.utils import HANZI_PATTERN
 
 PHRASE_PLACEHOLDER_MSG = "Loading translation..."
@@ -13,19 +20,14 @@ PHRASE_PLACEHOLDER_MSG = "Loading translation..."
 PHRASE_MAX_LENGTH = 30
 PHRASE_DELIMITERS = ["。？", "；：，", "、"] #, "「」（）"]
 
-def _split_phrases(xml_string, i=0):
-
-    xml_string = xml_string.strip(''.join(PHRASE_DELIMITERS))
-
-    if not re.search(rf'[{HANZI_PATTERN}\d+]', xml_string):
-        return None
-
-    if i == len(PHRASE_DELIMITERS):
-        return [xml_string]
+# Part of the translation cache key - change these when changing the prompts, so old translations aren't reused
+PHRASE_PROMPT_VERSION = '1'
+PHRASE_BATCH_PROMPT_VERSION = 'batch-1'
 
-    if i > 0 and len(get_text(xml_string)) <= PHRASE_MAX_LENGTH:
-        return [xml_string]
+# Number of phrases to translate per GPT request
+PHRASE_BATCH_SIZE = 20
 
+def _get_split_pattern(i):
     pattern = rf'[{re.escape(PHRASE_DELIMITERS[i])}]'
 
     if i == 0:
@@ -35,42 +37,69 @@ def _split_phrases(xml_string, i=0):
         ]
         pattern = '|'.join(f'(?:{p})' for p in split_patterns)
 
-    if re.search(pattern, xml_string):
+    return re.compile(pattern)
+
+_SPLIT_PATTERNS = [_get_split_pattern(i) for i in range(len(PHRASE_DELIMITERS))]
+_HAS_TEXT_PATTERN = re.compile(rf'[{HANZI_PATTERN}\d+]')
+
+
+def _split_phrases(doc, start, end, i=0):
+    """
+    Returns (start, end) spans of doc.xml_string to annotate as phrases. Works on offsets into the document rather than
+    on copies of it, so the text of a span can be looked up without parsing it again.
+    """
+    xml_string = doc.xml_string
+
+    delimiters = ''.join(PHRASE_DELIMITERS)
+    while start < end and xml_string[start] in delimiters:
+        start += 1
+    while end > start and xml_string[end - 1] in delimiters:
+        end -= 1
+
+    if not _HAS_TEXT_PATTERN.search(xml_string, start, end):
+        return None
+
+    if i == len(PHRASE_DELIMITERS):
+        return [(start, end)]
+
+    if i > 0 and len(doc.get_text(start, end)) <= PHRASE_MAX_LENGTH:
+        return [(start, end)]
+
+    pattern = _SPLIT_PATTERNS[i]
+
+    if pattern.search(xml_string, start, end):
         phrases = []
-        for xml_chunk in re.split(pattern, xml_string):
-            if xml_chunk:
-                # print(f"{'    ' * i}chunk: {xml_chunk}")
-                chunk_phrases = _split_phrases(xml_chunk, i + 1)
+        chunk_start = start
+        for m in [*pattern.finditer(xml_string, start, end), None]:
+            chunk_end = m.start() if m else end
+            if chunk_end > chunk_start:
+                chunk_phrases = _split_phrases(doc, chunk_start, chunk_end, i + 1)
                 if chunk_phrases:
                     phrases += chunk_phrases
+            if m:
+                chunk_start = m.end()
         return phrases
     else:
-        return _split_phrases(xml_string, i + 1)
+        return _split_phrases(doc, start, end, i + 1)
 
 
-def _get_phrase_annotations(xml_string):
+def _get_phrase_annotations(doc):
 
-    phrase_chunks = _split_phrases(xml_string)
+    phrase_spans = _split_phrases(doc, 0, len(doc.xml_string))
 
     annotations = []
-    if phrase_chunks:
-        i = 0
-        for chunk in phrase_chunks:
-            a_start = xml_string.find(chunk, i)
-            a_length = len(chunk)
-            a_text = get_text(chunk)
+    if phrase_spans:
+        for a_start, a_end in phrase_spans:
+            a_text = doc.get_text(a_start, a_end).lstrip(' \t\r\n')
             if a_text:
                 CONTEXT_SIZE = 30
-                a_context = get_text(
-                    xml_string[max(a_start - CONTEXT_SIZE, 0):a_start + a_length + CONTEXT_SIZE]
-                )
-                annotations.append((a_start, a_length, a_text, a_context))
-            i = a_start + a_length
+                a_context = doc.get_text(max(a_start - CONTEXT_SIZE, 0), a_end + CONTEXT_SIZE)
+                annotations.append((a_start, a_end - a_start, a_text, a_context))
 
     return annotations
 
 
-async def _get_phrase_translation(phrase_text, surrounding_text):
+def _add_trailing_punctuation(phrase_text, surrounding_text):
 
     assert phrase_text in surrounding_text, (phrase_text, surrounding_text)
 
@@ -78,6 +107,12 @@ async def _get_phrase_translation(phrase_text, surrounding_text):
     INCLUDE_TRAILING_CHARS = "。，？"
     if next_char in INCLUDE_TRAILING_CHARS:
         phrase_text = f'{phrase_text}{next_char}'
+    return phrase_text
+
+
+async def _get_phrase_translation(phrase_text, surrounding_text):
+
+    phrase_text = _add_trailing_punctuation(phrase_text, surrounding_text)
 
     prompt = f"""
     You are a Chinese teacher. Please translate the following phrase into English:
@@ -95,65 +130,185 @@ async def _get_phrase_translation(phrase_text, surrounding_text):
     {{"translation": <your translation>}}
     """
 
+    model = gpt.DEFAULT_MODEL
+    cache_key = translation_cache.get_key(PHRASE_PROMPT_VERSION, phrase_text, surrounding_text, model=model)
+    res = await translation_cache.aget(cache_key)
+    if res is not None:
+        return res
+
     try:
-        res = (await gpt.get_response_async(prompt=prompt, json_keys=['translation']))['translation']
+        res = (await gpt.get_response_async(prompt=prompt, json_keys=['translation'], model=model))['translation']
     except Exception as e:
         traceback.print_exc()
         print("Error getting phrase translation with GPT")
-        res = "Translation unavailable"
+        return "Translation unavailable"
 
+    await translation_cache.aset(cache_key, res)
     return res
 
 
+class PhraseTranslationResult(BaseModel):
+    id: int
+    translation: str
 
-async def _update_phrase(phrase, cb):
-    phrase.english = await _get_phrase_translation(phrase.text, phrase.context)
-    phrase.is_placeholder = False
-    await phrase.asave()
-    if cb:
-        await cb(phrase)
 
+class PhraseTranslationResults(BaseModel):
+    translations: list[PhraseTranslationResult]
 
 
-def annotate_phrases_with_placeholders(article):
+def _get_batch_cache_key(phrase):
+    phrase_text = _add_trailing_punctuation(phrase.text, phrase.context)
+    return translation_cache.get_key(
+        PHRASE_BATCH_PROMPT_VERSION, phrase_text, phrase.context, model=gpt_structured.DEFAULT_MODEL,
+    )
 
-    Annotation.objects.filter(article=article, type=Annotation.TYPE_PHRASE).delete()
 
-    n_annotations = 0
-    for field in [Annotation.FIELD_TITLE, Annotation.FIELD_BODY]:
-        if article.get_field(field):
-            for i, length, phrase_text, phrase_context in _get_phrase_annotations(article.get_field(field)):
-                phrase = PhraseAnnotation(
-                    text=phrase_text,
-                    context=phrase_context,
-                    english=PHRASE_PLACEHOLDER_MSG,
-                    is_placeholder=True,
-                )
-                phrase.save()
-                annotation = Annotation(
-                    article=article,
-                    field=field,
-                    type=Annotation.TYPE_PHRASE,
-                    start=i,
-                    length=length,
-                    phrase=phrase,
-                )
-                annotation.save()
-                n_annotations += 1
-    print(f"Saved {n_annotations} placeholder phrase annotations.")
+async def _iter_phrase_translations(phrases):
+    """
+    Translates a batch of phrases with one request, yielding (index into phrases, translation) for each phrase as soon
+    as its translation has been received.
+    """
+    phrase_list = "\n\n".join(
+        f'{i}. "{_add_trailing_punctuation(phrase.text, phrase.context)}"\n'
+        f'Context: "...{phrase.context}..."'
+        for i, phrase in enumerate(phrases)
+    )
+    # Indent the list like the rest of the prompt, so it's all dedented together
+    phrase_list = textwrap.indent(phrase_list, ' ' * 4).lstrip()
+    prompt = f"""
+    You are a Chinese teacher. Please translate each of the following phrases into English. Each phrase is numbered,
+    and followed by the context it appears in:
 
+    {phrase_list}
 
-async def update_phrase_annotations(article, cb):
+    You can use the context to assist your translation, but do not include it in your translation. You must only
+    translate the target phrase. Return a translation for every phrase, in order, with its number as the id.
+    """
+
+    n_done = 0
+    async for parsed, is_complete in gpt_structured.iter_response_structured_async(prompt, PhraseTranslationResults):
+        if is_complete:
+            results = [(x.id, x.translation) for x in parsed.translations]
+        else:
+            # The last result may still be cut off
+            results = [
+                (x.get('id'), x.get('translation'))
+                for x in (parsed.get('translations') or [])[:-1]
+            ]
+        for i, translation in results[n_done:]:
+            if isinstance(i, int) and 0 <= i < len(phrases) and translation:
+                yield i, translation
+        n_done = len(results)
+
+
+async def _save_phrase(phrase, english, cb):
+    phrase.english = english
+    phrase.is_placeholder = False
+    await phrase.asave()
+    await ReaderPayload.objects.ainvalidate(phrase.annotation.article_id)
+    if cb:
+        await cb(phrase)
+
+
+async def _update_phrase(phrase, cb):
+    await _save_phrase(phrase, await _get_phrase_translation(phrase.text, phrase.context), cb)
+
+
+async def _update_phrase_batch(phrases, cb):
+    to_translate = []
+    for phrase in phrases:
+        english = await translation_cache.aget(_get_batch_cache_key(phrase))
+        if english is not None:
+            await _save_phrase(phrase, english, cb)
+        else:
+            to_translate.append(phrase)
+    if not to_translate:
+        return
+
+    untranslated = to_translate
+    for attempt in range(gpt.N_ATTEMPTS):
+        batch = dict(enumerate(untranslated))
+        retry_delay = None
+        try:
+            async for i, english in _iter_phrase_translations(untranslated):
+                phrase = batch.pop(i, None)
+                if phrase:
+                    await translation_cache.aset(_get_batch_cache_key(phrase), english)
+                    await _save_phrase(phrase, english, cb)
+        except RateLimitError as e:
+            # Splitting the batch up now would only make more requests, so wait and retry whatever it didn't return
+            retry_delay = await scheduler.aon_rate_limited(gpt_structured.DEFAULT_MODEL, e.response.headers, attempt)
+        except Exception:
+            traceback.print_exc()
+            print("Error getting batched phrase translations with GPT")
+
+        untranslated = list(batch.values())
+        if retry_delay is None or not untranslated:
+            break
+        print(f"Rate limited - retrying {len(untranslated)} phrases in {retry_delay:.1f} seconds")
+        await asyncio.sleep(retry_delay)
+
+    # Fall back to one request per phrase for anything the batch didn't return
+    await asyncio.gather(*[_update_phrase(phrase, cb) for phrase in untranslated], return_exceptions=True)
+
+
+def annotate_phrases_with_placeholders(article, docs=None):
+
+    docs = docs or parse_article(article)
+    field_annotations = [
+        (field, annotation)
+        for field, doc in docs.items()
+        for annotation in _get_phrase_annotations(doc)
+    ]
+
+    with transaction.atomic():
+        Annotation.objects.delete_phrases(article)
+
+        # On Postgres, bulk_create sets the pks, so the Annotations can refer to the new phrases
+        phrases = PhraseAnnotation.objects.bulk_create([
+            PhraseAnnotation(
+                text=phrase_text,
+                context=phrase_context,
+                english=PHRASE_PLACEHOLDER_MSG,
+                is_placeholder=True,
+            )
+            for _, (_, _, phrase_text, phrase_context) in field_annotations
+        ])
+        Annotation.objects.bulk_create([
+            Annotation(
+                article=article,
+                field=field,
+                type=Annotation.TYPE_PHRASE,
+                start=i,
+                length=length,
+                phrase=phrase,
+            )
+            for (field, (i, length, _, _)), phrase in zip(field_annotations, phrases)
+        ])
+        ReaderPayload.objects.invalidate(article.pk)
+    print(f"Saved {len(phrases)} placeholder phrase annotations.")
+
+
+async def update_phrase_annotations(article, cb, batch_size=PHRASE_BATCH_SIZE):
+    """
+    Translates the article's placeholder phrases, calling cb with each phrase once it's saved. With a batch_size, sends
+    that many phrases per request, otherwise one request per phrase.
+    """
 
     phrases = PhraseAnnotation.objects.filter(
         annotation__article=article,
         annotation__type=Annotation.TYPE_PHRASE,
         is_placeholder=True,
-    ).select_related('annotation__article')
+    ).select_related('annotation__article').order_by('annotation__start')
+    phrases = [phrase async for phrase in phrases]
 
-    phrase_tasks = []
-    async for phrase in phrases:
-        phrase_tasks.append(_update_phrase(phrase, cb))
+    if batch_size:
+        phrase_tasks = [
+            _update_phrase_batch(phrases[i:i + batch_size], cb)
+            for i in range(0, len(phrases), batch_size)
+        ]
+    else:
+        phrase_tasks = [_update_phrase(phrase, cb) for phrase in phrases]
 
     await asyncio.gather(*phrase_tasks, return_exceptions=True)
 
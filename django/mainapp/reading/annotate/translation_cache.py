@@ -0,0 +1,78 @@
+"""
+Postgres-backed cache of GPT phrase translations.
+
+The same phrase often turns up in the same context (common sentences, re-submitted articles), so translations are
+cached under a hash of the normalised prompt inputs and the model. Entries expire after PHRASE_TRANSLATION_CACHE_TTL,
+and evict() keeps the table to PHRASE_TRANSLATION_CACHE_SIZE rows, dropping the least recently used first.
+"""
+import re
+import unicodedata
+from collections import Counter
+
+import xxhash
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from mainapp.models import PhraseTranslation
+
+# Hit/miss counts for this process, see log_stats
+stats = Counter()
+
+
+def _normalise(s):
+    return re.sub(r'\s+', ' ', unicodedata.normalize('NFKC', s)).strip()
+
+
+def get_key(*inputs, model):
+    return xxhash.xxh64('\x00'.join([model, *(_normalise(x) for x in inputs)]).encode()).hexdigest()
+
+
+def log_stats():
+    # Called once per update_phrase_annotations run, rather than on every lookup
+    total = stats['hits'] + stats['misses']
+    if not total:
+        return
+    print(f"Phrase translation cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hits'] / total:.0%} hit rate)")
+
+
+async def aget(key):
+    translation = await PhraseTranslation.objects.filter(
+        key=key,
+        created_at__gte=timezone.now() - settings.PHRASE_TRANSLATION_CACHE_TTL,
+    ).afirst()
+
+    if translation is None:
+        stats['misses'] += 1
+        return None
+
+    stats['hits'] += 1
+    await PhraseTranslation.objects.filter(pk=translation.pk).aupdate(
+        last_used_at=timezone.now(),
+        n_hits=F('n_hits') + 1,
+    )
+    return translation.english
+
+
+async def aset(key, english):
+    await PhraseTranslation.objects.aupdate_or_create(
+        key=key,
+        defaults={'english': english, 'created_at': timezone.now(), 'last_used_at': timezone.now()},
+    )
+
+
+def evict():
+    n_expired, _ = PhraseTranslation.objects.filter(
+        created_at__lt=timezone.now() - settings.PHRASE_TRANSLATION_CACHE_TTL,
+    ).delete()
+
+    # Everything less recently used than the newest PHRASE_TRANSLATION_CACHE_SIZE entries
+    cutoff = list(PhraseTranslation.objects.order_by('-last_used_at').values_list('last_used_at', flat=True)[
+        settings.PHRASE_TRANSLATION_CACHE_SIZE:settings.PHRASE_TRANSLATION_CACHE_SIZE + 1
+    ])
+    n_evicted = 0
+    if cutoff:
+        n_evicted, _ = PhraseTranslation.objects.filter(last_used_at__lte=cutoff[0]).delete()
+
+    if n_expired or n_evicted:
+        print(f"Phrase translation cache: removed {n_expired} expired and {n_evicted} least recently used entries")
@@ -1,30 +1,37 @@
 import re
 import traceback
 
-from asgiref.sync import async_to_sync, sync_to_async
-from django.db import transaction, IntegrityError
+from django.conf import settings
+from django.db import transaction
 
-from mainapp.models import Annotation, Word, CharacterPinyin, Meaning, Definition, Character, Pinyin, Syllable
-from mainapp.reading.utils import iter_text
+from mainapp.models import Annotation, Word, CharacterPinyin, ReaderPayload
+from mainapp.reading import dictionary, jieba_dict, trie
+from mainapp.reading.document import parse_article
 from mainapp.utils import HANZI_PATTERN
 
-import jieba
-jieba.initialize()
-
 def _should_annotate(char_string):
     return bool(re.fullmatch(rf'[{HANZI_PATTERN}]+', char_string))
 
-def _split_words(s):
+SEGMENTER_JIEBA = 'jieba'
+SEGMENTER_TRIE = 'trie'
+
+def _split_words(s, engine=None):
     if not s:
         return []
-    words = list(jieba.cut(s))
+    engine = engine or settings.SEGMENTATION_ENGINE
+    if engine == SEGMENTER_JIEBA:
+        words = list(jieba_dict.get_tokenizer().cut(s))
+    elif engine == SEGMENTER_TRIE:
+        words = trie.get_segmenter().segment(s)
+    else:
+        raise AssertionError(f"Unknown segmentation engine: {engine}")
     assert ''.join(words) == s
     return words
 
 def _get_individual_cps(word):
     cps = []
     for c in word:
-        cp = CharacterPinyin.objects.filter(character__char=c).first()
+        cp = next(iter(dictionary.index.get_cps(c)), None)
         if cp:
             cps.append(cp)
         else:
@@ -33,182 +40,68 @@ def _get_individual_cps(word):
 
     return cps
 
-def _get_or_create_db_object(word_str, word_data):
-    if word_data:
-        assert word_data['word'] == word_str
-        word, pinyin, definition = word_data['word'], word_data['pinyin'], word_data['definition']
-    else:
-        word, pinyin, definition = word_str, None, None
-
-    if not _should_annotate(word):
-        return None
-
-    if len(word) == 1:
-        if not pinyin:
-            cp = CharacterPinyin.objects.filter(character__char=word).first()
-            if cp:
-                return cp
-            else:
-                print(f"UserWarning: No CP exists with any pinyin for character {word['word']}")
-                return None
-
-        try:
-            cp = CharacterPinyin.objects.get(character__char=word, pinyin__written=pinyin)
-            with transaction.atomic():
-                meaning = Meaning.objects.select_for_update().get(pk=cp.meaning.pk)
-                meaning.definition_set.all().delete()
-                Definition.objects.create(
-                    meaning=meaning,
-                    text=definition,
-                    order=0,
-                )
-                cp.client_obj = cp.compute_client_obj()
-                cp.save()
-            return cp
-
-        except CharacterPinyin.DoesNotExist:
-            print(f"UserWarning: Creating new unverified CP: {word}/{pinyin}")
-            try:
-                cp, created = CharacterPinyin.objects.get_or_create(
-                    character=Character.objects.get(char=word),
-                    pinyin=Pinyin.objects.get_from_str(pinyin),
-                )
-                if created:
-                    cp.client_obj = cp.compute_client_obj()
-                    cp.save()
-            except (Syllable.DoesNotExist, Pinyin.DoesNotExist):
-                print(f"UserWarning: Unknown pinyin: {pinyin} - check the characters carefully, this may be because GPT gave a weird character that looks the same but is wrong")
-                cp = None
-
-            return cp
-
-    else:
-        if not pinyin:
-            obj = Word.objects.filter(char_string=word).first()
-            if obj:
-                return obj
-            else:
-                print(f"UserWarning: No Word exists with any pinyin for character {word}, falling back to individual characters")
-                return _get_individual_cps(word)
-
-        try:
-            obj = Word.objects.get(char_string=word, pinyin_string=pinyin)
-            with transaction.atomic():
-                meaning = Meaning.objects.select_for_update().get(pk=obj.meaning.pk)
-                meaning.definition_set.all().delete()
-                Definition.objects.create(
-                    meaning=meaning,
-                    text=definition,
-                    order=0,
-                )
-                obj.client_obj = obj.compute_client_obj()
-                obj.save()
-            return obj
-
-        except Word.DoesNotExist:
-            print(f"UserWarning: Creating new unverified word: {word}/{pinyin}")
-            try:
-                obj = Word.create_from_chars(
-                    char_string=word,
-                    pinyin_list=pinyin.split(' '),
-                    definition=definition,
-                )
-            except (Pinyin.DoesNotExist, Syllable.DoesNotExist):
-                print(f"UserWarning: Unknown pinyin: {pinyin} - check the characters carefully, this may be because GPT gave a weird character that looks the same but is wrong")
-                obj = None
-
-            except IntegrityError:
-                # Probably a race condition where the Word was already created by another process
-                obj = Word.objects.get(char_string=word, pinyin_string=word)
-
-            return obj
-
-
 def _get_db_object(word):
     if not _should_annotate(word):
         return None
 
-    if len(word) == 1:
-        n_cps = len(Character.objects.get(char=word).get_common_pinyins())
-        if n_cps == 1:
-            cp = CharacterPinyin.objects.filter(
-                character__char=word,
-            ).first()
-            return cp
-        else:
-            return None
+    # Resolved from the in-memory index, so this doesn't touch the database
+    return dictionary.index.get_unique(word)
 
-    elif len(word) > 1:
-        db_words = Word.objects.filter(char_string=word)
-        n_words = len(db_words)
-        if n_words == 1:
-            return db_words.first()
-        else:
-            return None
 
+def _fetch_missing_from_index(words):
+    """
+    The index only knows what existed when it was loaded, plus anything created by this process since. Fetch any
+    other entries these tokens need (e.g. created by another worker) with one Word and one CharacterPinyin query.
+    """
+    index = dictionary.index
+    missing_words = {w for w in words if len(w) > 1 and not index.contains(w)}
+    missing_chars = {c for w in words for c in w if not index.contains(c)}
 
-async def _enrich_words(words, s, use_gpt=True):
-    assert ''.join(words) == s, (words, s)
+    if missing_words:
+        for word in Word.objects.filter(char_string__in=missing_words).only('pk', 'char_string'):
+            index.add_word(word)
+    if missing_chars:
+        for cp in CharacterPinyin.objects.filter(character__char__in=missing_chars).select_related('character', 'pinyin'):
+            index.add_cp(cp)
 
-    word_objs = [
-        {'word': word, 'obj': await sync_to_async(_get_db_object)(word) if _should_annotate(word) else None}
-        for word in words
-    ]
-
-    unclear_words = []
-    for x in word_objs:
-        if _should_annotate(x['word']) and x['obj'] is None and x['word'] not in unclear_words:
-            unclear_words.append(x['word'])
 
-    unclear_words_enriched = {word: None for word in unclear_words}
+def _get_fallback_db_object(word):
+    # Used when there isn't exactly one match for the word in the dictionary index
+    if len(word) == 1:
+        cp = next(iter(dictionary.index.get_cps(word)), None)
+        if not cp:
+            print(f"UserWarning: No CP exists with any pinyin for character {word}")
+        return cp
 
-    unclear_word_objs = {
-        word: await sync_to_async(_get_or_create_db_object)(word, word_data)
-        for word, word_data in unclear_words_enriched.items()
-    }
+    obj = next(iter(dictionary.index.get_words(word)), None)
+    if obj:
+        return obj
+    else:
+        print(f"UserWarning: No Word exists with any pinyin for character {word}, falling back to individual characters")
+        return _get_individual_cps(word)
 
-    for x in word_objs:
-        if x['obj'] is None and x['word'] in unclear_word_objs:
-            x['obj'] = unclear_word_objs[x['word']]
-
-    word_objs = [
-        {
-            'word': x['word'],
-            'obj': await sync_to_async(_prefetch_fields)(x['obj'])
-        }
-        for x in word_objs
-    ]
 
-    assert ''.join([x['word'] for x in word_objs]) == s, (word_objs, s)
-    return word_objs
+def _get_db_objects(words):
+    """
+    Resolves all tokens of a text chunk together, returning [{'word': ..., 'obj': ...}] in the same order. CPs are
+    returned with their character and pinyin already loaded.
+    """
+    dictionary.index.ensure_loaded()
 
+    to_annotate = {w for w in words if _should_annotate(w)}
+    _fetch_missing_from_index(to_annotate)
 
+    resolved = {}
+    for word in to_annotate:
+        resolved[word] = _get_db_object(word) or _get_fallback_db_object(word)
 
-def _prefetch_fields(obj):
-    if not obj:
-        return None
-    if isinstance(obj, list):
-        return [
-            CharacterPinyin.objects.select_related('character', 'pinyin').get(pk=cp.pk)
-            for cp in obj
-        ]
-    elif isinstance(obj, Word):
-        return obj
-    elif isinstance(obj, CharacterPinyin):
-        return CharacterPinyin.objects.select_related('character', 'pinyin').get(pk=obj.pk)
+    return [{'word': word, 'obj': resolved.get(word)} for word in words]
 
 
-async def _get_annotations_plain(s, use_gpt=True):
+def _get_annotations(s, engine=None):
     try:
-        words = _split_words(s)
-        word_objs = await _enrich_words(words, s, use_gpt=use_gpt)
-        word_objs = [
-            {
-                'word': x['word'],
-                'obj': await sync_to_async(_prefetch_fields)(x['obj'])
-            }
-            for x in word_objs
-        ]
+        words = _split_words(s, engine=engine)
+        word_objs = _get_db_objects(words)
 
     except Exception as e:
         traceback.print_exc()
@@ -232,57 +125,62 @@ async def _get_annotations_plain(s, use_gpt=True):
 
     return annotations
 
-async def save_annotations_for_chunk(article, idx, length, use_gpt=True, cb=None):
-    s = article.body[idx:idx + length]
-    assert '<' not in s and '>' not in s, "This is supposed to be a single text node, it cannot contain any tags"
-    annotations = [
-        (x[0] + idx, x[1], x[2])
-        for x in await _get_annotations_plain(s, use_gpt=use_gpt)
-    ]
-    for a_i, a_length, cp_or_word in annotations:
-        assert article.body[a_i:a_i+a_length] == cp_or_word.char_string, (article.body[a_i:a_i+a_length], cp_or_word.char_string)
-
-
-    print("starting save")
-    annotations_for_saving = []
-    new_cps, new_words = set(), set()  # Collect these for sending to the client
-    for a_i, a_length, cp_or_word in annotations:
-        annotation_type = {
-            Word: Annotation.TYPE_WORD,
-            CharacterPinyin: Annotation.TYPE_CHARACTER,
-        }[type(cp_or_word)]
-        annotations_for_saving.append(Annotation(
-            article=article,
-            field=Annotation.FIELD_BODY,
-            type=annotation_type,
-            start=a_i,
-            length=a_length,
-            word=cp_or_word if annotation_type == Annotation.TYPE_WORD else None,
-            cp=cp_or_word if annotation_type == Annotation.TYPE_CHARACTER else None
-        ))
-        if isinstance(cp_or_word, CharacterPinyin):
-            new_cps.add(cp_or_word)
-        elif isinstance(cp_or_word, Word):
-            new_words.add(cp_or_word)
-
-    print(await Annotation.objects.filter(
-        article=article,
-        type__in=[Annotation.TYPE_WORD, Annotation.TYPE_CHARACTER],
-        start__gte=idx,
-        start__lt=idx + length,
-    ).adelete())
-    await Annotation.objects.abulk_create(annotations_for_saving)
-    print(f"Saved {len(annotations_for_saving)} word/CP annotations")
-    if cb:
-        await cb(new_cps, new_words)
-
-
-
-def fast_annotate(article):
+
+def get_text_node_annotations(text_nodes, engine=None):
     """
-    Annotate all Words and CPs in the article using jieba with no GPT calls.
+    Annotates each (index, text) text node of an article body, returning (start, length, type, word_pk, cp_pk) tuples.
+    These are plain values so they can be passed between celery tasks, see tasks.process_article.
     """
-    for i, text_chunk in iter_text(article.body):
-        async_to_sync(save_annotations_for_chunk)(article, i, len(text_chunk), use_gpt=False)
+    res = []
+    for idx, text in text_nodes:
+        assert '<' not in text and '>' not in text, "This is supposed to be a single text node, it cannot contain any tags"
+        for i, length, cp_or_word in _get_annotations(text, engine=engine):
+            if isinstance(cp_or_word, Word):
+                res.append((idx + i, length, Annotation.TYPE_WORD, cp_or_word.pk, None))
+            else:
+                res.append((idx + i, length, Annotation.TYPE_CHARACTER, None, cp_or_word.pk))
+    return res
 
 
+def save_annotations(article, annotations):
+    """
+    Replaces all of the article's Word and CP annotations with (start, length, type, word_pk, cp_pk) annotations, in one
+    transaction.
+    """
+    with transaction.atomic():
+        Annotation.objects.replace_word_annotations(article.pk, annotations)
+        ReaderPayload.objects.invalidate(article.pk)
+    print(f"Saved {len(annotations)} word/CP annotations")
+
+
+def fast_annotate(article, engine=None, docs=None):
+    """
+    Annotate all Words and CPs in the article using jieba (or another segmentation engine) with no GPT calls. This
+    annotates the text nodes one after another - process_article splits them between celery tasks instead.
+    """
+    docs = docs or parse_article(article)
+    if Annotation.FIELD_BODY not in docs:
+        return
+    save_annotations(article, get_text_node_annotations(docs[Annotation.FIELD_BODY].text_nodes, engine=engine))
+
+
+def reannotate_text_nodes(article, spans, docs=None, engine=None):
+    """
+    Re-annotates only the body text nodes overlapping the (start, end) spans, e.g. after words have been added to the
+    dictionary. Returns the (start, end) spans of the text nodes that were re-annotated, and their new annotations.
+    """
+    docs = docs or parse_article(article)
+    if Annotation.FIELD_BODY not in docs:
+        return [], []
+    text_nodes = [
+        (i, text) for i, text in docs[Annotation.FIELD_BODY].text_nodes
+        if any(start < i + len(text) and i < end for start, end in spans)
+    ]
+    text_node_spans = [(i, i + len(text)) for i, text in text_nodes]
+    annotations = get_text_node_annotations(text_nodes, engine=engine)
+
+    with transaction.atomic():
+        Annotation.objects.replace_word_annotations(article.pk, annotations, spans=text_node_spans)
+        ReaderPayload.objects.invalidate(article.pk)
+    print(f"Re-annotated {len(text_nodes)} text nodes with {len(annotations)} word/CP annotations")
+    return text_node_spans, annotations
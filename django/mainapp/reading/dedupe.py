@@ -0,0 +1,84 @@
+"""
+Reusing the results of processing an identical article.
+
+Many users submit the same sample articles, or the same news story. Articles are keyed by a hash of their title and
+cleaned body, so when one has already been processed we can copy its annotations, phrase translations and summary
+instead of running jieba and GPT again.
+"""
+import xxhash
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+
+from mainapp.models import Article, Annotation, PhraseAnnotation, ReaderPayload
+
+
+def get_content_hash(article):
+    return xxhash.xxh64(f"{article.title or ''}\n\n{article.body or ''}".encode()).hexdigest()
+
+
+def find_source_article(article):
+    """
+    Returns the earliest processed article with the same content as this one, or None. Articles are ready to view
+    before their phrases are translated, so only those with every phrase translated count - otherwise the copies'
+    placeholders would be sent to GPT again.
+    """
+    untranslated_phrases = Annotation.objects.filter(
+        article=OuterRef('pk'),
+        type=Annotation.TYPE_PHRASE,
+        phrase__is_placeholder=True,
+    )
+    return Article.objects.filter(
+        ~Exists(untranslated_phrases),
+        content_hash=article.content_hash,
+        is_ready_to_view=True,
+    ).exclude(pk=article.pk).order_by('pk').first()
+
+
+def copy_processed_fields(source, article):
+    """
+    Copies the annotations (with their phrase translations), plaintext and summary of source to article. The inflated
+    XML refers to phrases by pk, so it needs to be rebuilt afterwards with inflate.save_inflated.
+    """
+    source_annotations = list(Annotation.objects.filter(
+        article=source,
+        type=Annotation.TYPE_PHRASE,
+    ).select_related('phrase').order_by('pk'))
+    source_word_annotations = Annotation.objects.get_word_annotation_values(source.pk)
+
+    with transaction.atomic():
+        Annotation.objects.delete_phrases(article)
+        Annotation.objects.replace_word_annotations(article.pk, source_word_annotations)
+
+        source_phrases = [a.phrase for a in source_annotations if a.phrase]
+        phrases = PhraseAnnotation.objects.bulk_create([
+            PhraseAnnotation(
+                text=phrase.text,
+                context=phrase.context,
+                english=phrase.english,
+                is_placeholder=phrase.is_placeholder,
+            )
+            for phrase in source_phrases
+        ])
+        new_phrases = {old.pk: new for old, new in zip(source_phrases, phrases)}
+
+        Annotation.objects.copy_insert([
+            Annotation(
+                article=article,
+                field=a.field,
+                type=a.type,
+                start=a.start,
+                length=a.length,
+                word_id=a.word_id,
+                cp_id=a.cp_id,
+                phrase=new_phrases.get(a.phrase_id),
+            )
+            for a in source_annotations
+        ])
+
+        article.plaintext = source.plaintext
+        article.english_title = article.english_title or source.english_title
+        article.english_summary = source.english_summary
+        article.save(update_fields=['plaintext', 'english_title', 'english_summary'])
+        ReaderPayload.objects.invalidate(article.pk)
+
+    print(f"Copied {len(source_annotations) + len(source_word_annotations)} annotations from article {source.pk}")
@@ -0,0 +1,143 @@
+"""
+Process-wide, read-mostly index of the dictionary, keyed by char_string.
+
+Resolving jieba tokens used to cost several queries per token. The index is loaded once per process (see the
+worker_process_init hook in tasks.py), so resolving a token needs no database access. It only stores pks and the few
+fields needed for annotating - model instances are built on demand, with all other fields deferred.
+
+The signals in signals.py apply this process's own changes to the index straight away, and bump DictionaryVersion.
+Other processes notice the new version within settings.DICTIONARY_INDEX_CHECK_INTERVAL and reload.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+from mainapp.models import Word, CharacterPinyin, Character, Pinyin, DictionaryVersion
+
+
+class DictionaryIndex:
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._words = None  # char_string -> tuple of Word pks, ascending
+        self._cps = None  # char -> tuple of (cp_pk, character_pk, pinyin_pk, pinyin_written, pinyin_tone), ascending
+        # Incremented on every load, and whenever the set of word strings changes, so things derived from the index
+        # (like the trie segmenter) know when to rebuild
+        self.generation = 0
+        self.version = None  # The DictionaryVersion that was loaded
+        self._next_check = 0
+
+    @property
+    def is_loaded(self):
+        return self._words is not None
+
+    def load(self):
+        # Read before the dictionary, so anything committed while loading gets it reloaded again at the next check
+        version = DictionaryVersion.objects.get_version()
+        words = {}
+        for pk, char_string in Word.objects.order_by('pk').values_list('pk', 'char_string').iterator(chunk_size=10000):
+            words.setdefault(char_string, []).append(pk)
+
+        cps = {}
+        for row in CharacterPinyin.objects.order_by('pk').values_list(
+            'pk', 'character_id', 'character__char', 'pinyin_id', 'pinyin__written', 'pinyin__tone',
+        ).iterator(chunk_size=10000):
+            pk, character_pk, char, pinyin_pk, written, tone = row
+            cps.setdefault(char, []).append((pk, character_pk, pinyin_pk, written, tone))
+
+        with self._lock:
+            self._words = {k: tuple(v) for k, v in words.items()}
+            self._cps = {k: tuple(v) for k, v in cps.items()}
+            self.generation += 1
+            self.version = version
+            self._next_check = time.monotonic() + settings.DICTIONARY_INDEX_CHECK_INTERVAL
+        print(f"Loaded dictionary index: {len(self._words)} word strings, {len(self._cps)} characters")
+
+    def ensure_loaded(self, check_now=False):
+        """
+        Loads the index, or reloads it if the dictionary has changed since. That's checked at most every
+        settings.DICTIONARY_INDEX_CHECK_INTERVAL seconds, unless check_now is set.
+        """
+        if self.is_loaded and not check_now and time.monotonic() < self._next_check:
+            return
+        with self._lock:
+            if self.is_loaded and not check_now and time.monotonic() < self._next_check:
+                return
+            if self.is_loaded and DictionaryVersion.objects.get_version() == self.version:
+                self._next_check = time.monotonic() + settings.DICTIONARY_INDEX_CHECK_INTERVAL
+            else:
+                self.load()
+
+    def add_word(self, word):
+        with self._lock:
+            if self.is_loaded:
+                pks = self._words.get(word.char_string, ())
+                self._words[word.char_string] = tuple(sorted({*pks, word.pk}))
+                if not pks:
+                    self.generation += 1
+
+    def remove_word(self, word):
+        with self._lock:
+            if self.is_loaded and word.char_string in self._words:
+                pks = tuple(x for x in self._words[word.char_string] if x != word.pk)
+                self._words[word.char_string] = pks
+                if not pks:
+                    self.generation += 1
+
+    def add_cp(self, cp):
+        with self._lock:
+            if self.is_loaded:
+                entries = {x[0]: x for x in self._cps.get(cp.character.char, ())}
+                entries[cp.pk] = (cp.pk, cp.character.pk, cp.pinyin.pk, cp.pinyin.written, cp.pinyin.tone)
+                self._cps[cp.character.char] = tuple(entries[k] for k in sorted(entries))
+
+    def remove_cp(self, cp):
+        # Deletes are rare, and cp.character may already be gone (e.g. cascading from Character), so just scan
+        with self._lock:
+            if self.is_loaded:
+                for char, entries in self._cps.items():
+                    if any(x[0] == cp.pk for x in entries):
+                        self._cps[char] = tuple(x for x in entries if x[0] != cp.pk)
+                        break
+
+    def contains(self, char_string):
+        self.ensure_loaded()
+        if len(char_string) == 1:
+            return char_string in self._cps
+        return char_string in self._words
+
+    def get_word_strings(self):
+        self.ensure_loaded()
+        return [k for k, v in self._words.items() if v]
+
+    def get_words(self, char_string):
+        self.ensure_loaded()
+        return [
+            Word.from_db(DEFAULT_DB_ALIAS, ['id', 'char_string'], [pk, char_string])
+            for pk in self._words.get(char_string, ())
+        ]
+
+    def get_cps(self, char):
+        self.ensure_loaded()
+        cps = []
+        for pk, character_pk, pinyin_pk, written, tone in self._cps.get(char, ()):
+            cp = CharacterPinyin.from_db(DEFAULT_DB_ALIAS, ['id', 'character_id', 'pinyin_id'], [pk, character_pk, pinyin_pk])
+            cp.character = Character.from_db(DEFAULT_DB_ALIAS, ['id', 'char'], [character_pk, char])
+            cp.pinyin = Pinyin.from_db(DEFAULT_DB_ALIAS, ['id', 'tone', 'written'], [pinyin_pk, tone, written])
+            cps.append(cp)
+        return cps
+
+    def get_unique(self, char_string):
+        """
+        Returns the CP (for single characters) or Word with this char_string, or None if there isn't exactly one.
+        """
+        if len(char_string) == 1:
+            objs = self.get_cps(char_string)
+        else:
+            objs = self.get_words(char_string)
+        return objs[0] if len(objs) == 1 else None
+
+
+index = DictionaryIndex()
@@ -0,0 +1,46 @@
+"""
+An article field's XML, parsed once and shared by every stage of process_article.
+"""
+import bisect
+
+from mainapp.models import Annotation
+from mainapp.reading.utils import iter_text
+
+
+class ParsedDocument:
+
+    def __init__(self, xml_string):
+        self.xml_string = xml_string
+        self.text_nodes = list(iter_text(xml_string))  # (char offset, text), in document order
+
+        self.plaintext = ''.join(text for _, text in self.text_nodes)
+        self._text_node_starts = [start for start, _ in self.text_nodes]
+
+    def get_text(self, start, end):
+        """
+        Returns the text in xml_string[start:end], without any markup (including tags cut off at either end).
+        """
+        res = []
+        i = max(bisect.bisect_right(self._text_node_starts, start) - 1, 0)
+        while i < len(self.text_nodes) and self.text_nodes[i][0] < end:
+            node_start, text = self.text_nodes[i]
+            res.append(text[max(start - node_start, 0):end - node_start])
+            i += 1
+        return ''.join(res)
+
+
+def parse_article(article):
+    """
+    Returns a dict of field -> ParsedDocument, for the article's non-empty fields.
+    """
+    return {
+        field: ParsedDocument(article.get_field(field))
+        for field in [Annotation.FIELD_TITLE, Annotation.FIELD_BODY]
+        if article.get_field(field)
+    }
+
+
+def get_plaintext(article, docs):
+    # Matches strip_tags(f"{article.title}\n\n{article.body}"), without parsing the body again
+    body = docs[Annotation.FIELD_BODY].plaintext if Annotation.FIELD_BODY in docs else ''
+    return f"{article.title or ''}\n\n{body}".strip()
@@ -1,14 +1,19 @@
+import bisect
 import itertools
-import uuid
-from collections import defaultdict
+import threading
+from collections import defaultdict, OrderedDict
 
-from mainapp.models import Annotation, Word, CharacterPinyin, update_atomic
-from mainapp.reading.utils import iter_text
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+
+from mainapp.models import Article, Annotation, Word, CharacterPinyin, ReaderPayload
+from mainapp.reading.document import ParsedDocument, parse_article
 
 import xxhash
 
 def _fasthash(str):
-    return xxhash.xxh32(str).hexdigest()[-6:]
+    return xxhash.xxh32(str.encode()).hexdigest()[-6:]
 
 def inflate_text(text, annotations, char_phrases, chunk_offset):
     assert len(char_phrases) == len(text)
@@ -18,7 +23,7 @@ def inflate_text(text, annotations, char_phrases, chunk_offset):
     for i, c in enumerate(text):
         if j == len(annotations):
             char_obj = None
-            group_key = uuid.uuid4().hex
+            group_key = -i - 1  # Annotation groups are keyed by index, so negative keys never collide with them
         else:
             if i >= annotations[j][0] + annotations[j][1]:
                 j += 1
@@ -28,7 +33,7 @@ def inflate_text(text, annotations, char_phrases, chunk_offset):
                 group_key = j
             else:
                 char_obj = None
-                group_key = uuid.uuid4().hex
+                group_key = -i - 1
 
         if c == ' ':
             c = '&nbsp;'
@@ -40,17 +45,22 @@ def inflate_text(text, annotations, char_phrases, chunk_offset):
             'phrase': char_phrases[i],
         })
 
-        counters = defaultdict(int)  # maps char_string -> current char_string_counter
-        group_keys_seen = set()
-        for char in chars:
-            if char['obj'] is None:
-                char_string = c
-            else:
-                char_string = char['obj'].char_string
-            if char['group_key'] not in group_keys_seen:
-                counters[char_string] += 1
-            char['cid'] = f"{chunk_offset}-{_fasthash(char_string)}-{counters[char_string]}"
-            group_keys_seen.add(char['group_key'])
+    # cids number the occurrences of each char_string in the chunk. Unannotated characters have always been counted
+    # under the chunk's last character rather than their own, which we keep so existing cids stay stable.
+    counters = defaultdict(int)  # maps char_string -> current char_string_counter
+    hashes = {}
+    prev_group_key = None
+    for char in chars:
+        if char['obj'] is None:
+            char_string = c
+        else:
+            char_string = char['obj'].char_string
+        if char['group_key'] != prev_group_key:
+            counters[char_string] += 1
+        if char_string not in hashes:
+            hashes[char_string] = _fasthash(char_string)
+        char['cid'] = f"{chunk_offset}-{hashes[char_string]}-{counters[char_string]}"
+        prev_group_key = char['group_key']
 
 
     def char_key(char):
@@ -78,52 +88,73 @@ def inflate_text(text, annotations, char_phrases, chunk_offset):
                 return f'<d:plain cid="{char["cid"]}" phrase="{char["phrase"].pk if char["phrase"] else ""}">{char["char"]}</d:plain>'
 
 
-    res = ''
-    for i, (k, g) in enumerate(itertools.groupby(chars, char_key)):
-        res += render_group(g, i)
-
-    return res
-
-
-def inflate_xml(article, field):
-
-    if not article.get_field(field):
-        return ''
-
-    annotations = list(Annotation.objects.filter(
-        article=article,
-        field=field,
-        type__in=[Annotation.TYPE_CHARACTER, Annotation.TYPE_WORD],
-    ).order_by('start'))
-    phrase_annotations = list(Annotation.objects.filter(
+    return ''.join(render_group(g, i) for i, (k, g) in enumerate(itertools.groupby(chars, char_key)))
+
+
+def _get_word_annotations(article, field, spans=None):
+    """
+    Returns (start, length, obj) for each of the article's Word and CP annotations in field, ordered by start, where obj
+    is the Word or CharacterPinyin (with its character loaded). If spans is given, only the annotations starting inside
+    one of those (start, end) spans, and the field's last annotation.
+    """
+    values = Annotation.objects.get_word_annotation_values(article.pk, field, spans)
+    if spans is not None:
+        # _inflate_text_nodes renders text after the field's last annotation without phrases, so it needs that one too
+        last = Annotation.objects.get_last_word_annotation_value(article.pk, field)
+        if last and (not values or last[0] > values[-1][0]):
+            values.append(last)
+    words = Word.objects.only('pk', 'char_string').in_bulk({word_pk for _, _, _, word_pk, _ in values if word_pk})
+    cps = CharacterPinyin.objects.select_related('character').only('pk', 'character__char').in_bulk({
+        cp_pk for _, _, _, _, cp_pk in values if cp_pk
+    })
+
+    annotations = []
+    for start, length, _, word_pk, cp_pk in values:
+        obj = words.get(word_pk) if word_pk else cps.get(cp_pk)
+        # Packed annotations can refer to Words and CPs that have since been deleted
+        if obj:
+            annotations.append((start, length, obj))
+    return annotations
+
+
+def _get_phrase_annotations(article, field, spans=None):
+    # If spans is given, only the phrase annotations overlapping one of those (start, end) spans
+    annotations = Annotation.objects.filter(
         article=article,
         field=field,
         type=Annotation.TYPE_PHRASE,
-    ).order_by('start'))
-
-    replacements = []
-    j = 0
-    k = 0
-    for i, text in iter_text(article.get_field(field)):
+    )
+    if spans is not None:
+        overlapping = Q()
+        for start, end in spans:
+            overlapping |= Q(start__lt=end, end__gt=start)
+        annotations = annotations.alias(end=F('start') + F('length')).filter(overlapping)
+    return list(annotations.select_related('phrase').only('start', 'length', 'phrase__id').order_by('start'))
+
+
+def _inflate_text_nodes(text_nodes, annotations, phrase_annotations):
+    """
+    Yields (i, text, inflated) for each (i, text) text node. Each text node is rendered on its own, so text_nodes can be
+    any of the field's text nodes, in document order.
+    """
+    annotation_starts = [start for start, _, _ in annotations]
+    phrase_ends = [a.end for a in phrase_annotations]
+
+    for i, text in text_nodes:
+        j = bisect.bisect_left(annotation_starts, i)
+        chunk_annotations = []
 
         if j == len(annotations):
-            chunk_annotations = []
             char_phrases = [None] * len(text)
         else:
-            chunk_annotations = []
-            if annotations:
-                while True:
-                    assert annotations[j].start >= i
-                    if annotations[j].end <= i + len(text):
-                        chunk_annotations.append(
-                            (annotations[j].start - i, annotations[j].length, annotations[j].word or annotations[j].cp)
-                        )
-                        j += 1
-                        if j == len(annotations):
-                            break
-                    else:
-                        break
+            while j < len(annotations):
+                start, length, obj = annotations[j]
+                if start + length > i + len(text):
+                    break
+                chunk_annotations.append((start - i, length, obj))
+                j += 1
 
+            k = bisect.bisect_right(phrase_ends, i)
             char_phrases = []
             for c in range(len(text)):
                 if k < len(phrase_annotations) and i + c >= phrase_annotations[k].end:
@@ -138,38 +169,211 @@ def inflate_xml(article, field):
                         char_phrase = None
                 char_phrases.append(char_phrase)
 
-        replacements.append((i, i+len(text), inflate_text(text, chunk_annotations, char_phrases, i)))
-
-    new_body = list(article.get_field(field))
-    for start, end, replace_with in reversed(replacements):
-        new_body[start:end] = replace_with
-
-    return ''.join(new_body)
-
-def save_inflated(article):
-    inflated = inflate_xml(article, Annotation.FIELD_TITLE) + inflate_xml(article, Annotation.FIELD_BODY)
-    update_atomic(article, 'inflated', inflated)
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+        yield i, text, inflate_text(text, chunk_annotations, char_phrases, i)
 
 
+def inflate_xml(article, field, doc=None):
 
+    if not article.get_field(field):
+        return ''
+    doc = doc or ParsedDocument(article.get_field(field))
+
+    annotations = _get_word_annotations(article, field)
+    phrase_annotations = _get_phrase_annotations(article, field)
+
+    # Text nodes are in document order, so the output is built in one pass
+    pieces = []
+    prev_end = 0
+    for i, text, inflated in _inflate_text_nodes(doc.text_nodes, annotations, phrase_annotations):
+        pieces.append(doc.xml_string[prev_end:i])
+        pieces.append(inflated)
+        prev_end = i + len(text)
+
+    pieces.append(doc.xml_string[prev_end:])
+    return ''.join(pieces)
+
+
+def render_inflated(article, docs=None):
+    docs = docs or parse_article(article)
+    return (
+        inflate_xml(article, Annotation.FIELD_TITLE, docs.get(Annotation.FIELD_TITLE)) +
+        inflate_xml(article, Annotation.FIELD_BODY, docs.get(Annotation.FIELD_BODY))
+    )
+
+
+def _store_inflated(article, inflated):
+    # Every change bumps inflated_version. In lazy mode only the version is stored, and get_inflated renders the XML
+    # on request (or finds it in the cache, if we have it)
+    Article.objects.filter(pk=article.pk).update(
+        inflated=None if settings.LAZY_INFLATION else inflated,
+        inflated_version=F('inflated_version') + 1,
+    )
+    article.refresh_from_db(fields=['inflated_version'])
+    if settings.LAZY_INFLATION:
+        article.inflated = None
+        if inflated is not None:
+            _inflated_cache.set((article.pk, article.inflated_version), inflated)
+    else:
+        article.inflated = inflated
+    ReaderPayload.objects.invalidate(article.pk)
+
+
+def save_inflated(article, docs=None):
+    _store_inflated(article, None if settings.LAZY_INFLATION else render_inflated(article, docs))
+
+
+class _InflatedCache:
+    """
+    Least recently used inflated XML, bounded by the total number of characters held rather than the number of articles.
+    """
+    def __init__(self, max_chars):
+        self.max_chars = max_chars
+        self.n_chars = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.items:
+                return None
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def set(self, key, value):
+        with self.lock:
+            if key in self.items:
+                self.n_chars -= len(self.items.pop(key))
+            self.items[key] = value
+            self.n_chars += len(value)
+            while self.n_chars > self.max_chars and self.items:
+                _, evicted = self.items.popitem(last=False)
+                self.n_chars -= len(evicted)
+
+
+_inflated_cache = _InflatedCache(settings.INFLATED_CACHE_MAX_CHARS)
+
+
+def get_inflated(article):
+    """
+    Returns the article's inflated XML, either stored or (with settings.LAZY_INFLATION) rendered and cached by
+    inflated_version. Returns None until the article has been inflated.
+    """
+    if article.inflated is not None or article.inflated_version == 0:
+        return article.inflated
+
+    key = (article.pk, article.inflated_version)
+    inflated = _inflated_cache.get(key)
+    if inflated is None:
+        inflated = render_inflated(article)
+        _inflated_cache.set(key, inflated)
+    return inflated
+
+
+def _skip_text_node(inflated, pos, text):
+    # Returns the end of the d: elements starting at pos that hold text's characters
+    n_chars = 0
+    while n_chars < len(text):
+        content_start = inflated.index('>', pos) + 1
+        content_end = inflated.index('</d:', content_start)
+        n_chars += content_end - content_start - 5 * inflated.count('&nbsp;', content_start, content_end)
+        pos = inflated.index('>', content_end) + 1
+    return pos
+
+
+def _get_text_node_spans(inflated, docs):
+    """
+    Returns {(field, i): (start, end)}, the span of the inflated XML rendered from each text node. The markup between
+    text nodes is copied as is, and each text node is rendered as d: elements that the markup can't appear inside, so
+    a text node's span ends where the markup after it is next found. Only text nodes with no markup after them (expat
+    splits text at newlines) need their d: elements walking through.
+    """
+    spans = {}
+    pos = 0
+    for field in [Annotation.FIELD_TITLE, Annotation.FIELD_BODY]:
+        if field not in docs:
+            continue
+        doc = docs[field]
+        markup_start = 0
+        for k, (i, text) in enumerate(doc.text_nodes):
+            markup = doc.xml_string[markup_start:i]
+            assert inflated.startswith(markup, pos), "Inflated XML doesn't match the article"
+            start = pos + len(markup)
+
+            markup_start = i + len(text)
+            next_i = doc.text_nodes[k + 1][0] if k + 1 < len(doc.text_nodes) else len(doc.xml_string)
+            next_markup = doc.xml_string[markup_start:next_i]
+            pos = inflated.index(next_markup, start) if next_markup else _skip_text_node(inflated, start, text)
+            spans[field, i] = (start, pos)
+
+        assert inflated.startswith(doc.xml_string[markup_start:], pos), "Inflated XML doesn't match the article"
+        pos += len(doc.xml_string) - markup_start
+
+    assert pos == len(inflated), "Inflated XML doesn't match the article"
+    return spans
+
+
+def _to_utf16_offsets(s, offsets):
+    # Converts increasing offsets into s to UTF-16 code units, which is how the reader's JavaScript indexes strings.
+    # Characters outside the BMP (like emoji) are one code point but two code units.
+    res = []
+    prev = 0
+    prev_utf16 = 0
+    for offset in offsets:
+        prev_utf16 += len(s[prev:offset].encode('utf-16-le')) // 2
+        prev = offset
+        res.append(prev_utf16)
+    return res
 
 
+def reinflate_text_nodes(article, changed, docs=None):
+    """
+    Re-renders only the text nodes overlapping the changed (field, start, end) annotation spans, and splices them into
+    the inflated XML. Returns (from_version, fragments), where fragments are (start, end, xml) replacements for spans
+    of the inflated XML at inflated_version from_version, in order. start and end are in UTF-16 code units, for the
+    reader to apply.
+
+    If there's no inflated XML to splice into, this inflates the whole article with save_inflated instead and returns
+    None. With settings.LAZY_INFLATION that's almost always the case, since the XML is only cached by the process that
+    rendered it (usually Daphne, not the Celery worker calling this).
+    """
+    docs = docs or parse_article(article)
+
+    with transaction.atomic():
+        # Locked, so two updates can't both splice into the same version
+        current = Article.objects.select_for_update().only('inflated', 'inflated_version').get(pk=article.pk)
+        from_version = current.inflated_version
+        inflated = current.inflated
+        if inflated is None and from_version:
+            inflated = _inflated_cache.get((article.pk, from_version))
+        if inflated is None:
+            save_inflated(article, docs)
+            return None
+
+        spans = _get_text_node_spans(inflated, docs)
+        fragments = []
+        for field in [Annotation.FIELD_TITLE, Annotation.FIELD_BODY]:
+            field_changed = [(start, end) for f, start, end in changed if f == field]
+            text_nodes = [
+                (i, text) for i, text in docs[field].text_nodes
+                if any(start < i + len(text) and i < end for start, end in field_changed)
+            ] if field in docs else []
+            if not text_nodes:
+                continue
+
+            text_node_spans = [(i, i + len(text)) for i, text in text_nodes]
+            annotations = _get_word_annotations(article, field, text_node_spans)
+            phrase_annotations = _get_phrase_annotations(article, field, text_node_spans)
+            for i, text, fragment in _inflate_text_nodes(text_nodes, annotations, phrase_annotations):
+                fragments.append((*spans[field, i], fragment))
+
+        pieces = []
+        prev_end = 0
+        for start, end, fragment in fragments:
+            pieces.append(inflated[prev_end:start])
+            pieces.append(fragment)
+            prev_end = end
+        pieces.append(inflated[prev_end:])
+        _store_inflated(article, ''.join(pieces))
+
+    offsets = _to_utf16_offsets(inflated, [offset for start, end, _ in fragments for offset in (start, end)])
+    return from_version, [(offsets[2 * k], offsets[2 * k + 1], xml) for k, (_, _, xml) in enumerate(fragments)]
@@ -0,0 +1,94 @@
+"""
+Jieba user dictionary generated from the Word table.
+
+With jieba's stock dictionary, word boundaries often don't match our Word entries, so we fall back to individual CPs.
+`manage.py build_jieba_dict` writes a dictionary containing our words (plus jieba's single characters), and lets
+jieba build its prefix dictionary cache next to it. Both files are keyed by a hash of the Word table, so workers load
+the cached prefix dictionary at boot instead of rebuilding it, and pick up a new one once the command is re-run.
+"""
+import os
+import tempfile
+import threading
+
+import jieba
+import xxhash
+from django.conf import settings
+from django.db import connection
+
+from mainapp.models import Word
+
+_lock = threading.Lock()
+_tokenizer = None
+
+
+def get_word_table_key():
+    # Hashes every (pk, char_string) in SQL, so it changes whenever words are added, deleted or edited. This is cheap
+    # enough to run at every boot (~30ms for 30k words)
+    table = connection.ops.quote_name(Word._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT md5(string_agg(id || ':' || char_string, ',' ORDER BY id)) FROM {table}")
+        digest, = cursor.fetchone()
+    return xxhash.xxh64((digest or '').encode()).hexdigest()
+
+
+def get_dict_path(key):
+    return os.path.join(settings.JIEBA_DICT_DIR, f'words.{key}.txt')
+
+
+def _make_tokenizer(key):
+    tokenizer = jieba.Tokenizer(dictionary=get_dict_path(key))
+    tokenizer.tmp_dir = settings.JIEBA_DICT_DIR
+    tokenizer.cache_file = f'words.{key}.cache'
+    return tokenizer
+
+
+def build_user_dict():
+    """
+    Writes the user dictionary for the current Word table, and builds its prefix dictionary cache.
+    """
+    key = get_word_table_key()
+    stock = jieba.Tokenizer()
+    stock.initialize()
+
+    # Keep jieba's single characters, so text between our words is weighted sensibly
+    entries = {word: freq for word, freq in stock.FREQ.items() if freq and len(word) == 1}
+    for char_string in Word.objects.values_list('char_string', flat=True).distinct().iterator(chunk_size=10000):
+        if char_string not in entries:
+            # Use jieba's frequency if it knows the word, otherwise just enough that it won't be split up
+            entries[char_string] = stock.FREQ.get(char_string) or stock.suggest_freq(char_string)
+
+    os.makedirs(settings.JIEBA_DICT_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=settings.JIEBA_DICT_DIR)
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        for word, freq in entries.items():
+            f.write(f'{word} {freq}\n')
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, get_dict_path(key))
+
+    _make_tokenizer(key).initialize()
+    return key, len(entries)
+
+
+def get_tokenizer():
+    global _tokenizer
+    if _tokenizer is None:
+        with _lock:
+            if _tokenizer is None:
+                key = get_word_table_key()
+                if os.path.isfile(get_dict_path(key)):
+                    tokenizer = _make_tokenizer(key)
+                else:
+                    print("UserWarning: No jieba user dictionary for the current Word table, using jieba's stock "
+                          "dictionary. Run `manage.py build_jieba_dict` to build it.")
+                    tokenizer = jieba.dt
+                tokenizer.initialize()
+                _tokenizer = tokenizer
+    return _tokenizer
+
+
+def add_words(char_strings):
+    # For Words created since the tokenizer was loaded, which it would otherwise split up until build_jieba_dict is run
+    tokenizer = get_tokenizer()
+    for char_string in char_strings:
+        if not tokenizer.FREQ.get(char_string):
+            tokenizer.add_word(char_string, tokenizer.suggest_freq(char_string))
@@ -0,0 +1,167 @@
+"""
+Maximum-match segmenter over a double-array trie of our own vocabulary.
+
+An alternative to jieba for _split_words: jieba's DAG + HMM is slow to initialise and holds its whole prefix
+dictionary in Python dicts, whereas this only knows the words we can actually annotate, stored in a few flat arrays.
+"""
+import re
+import threading
+from array import array
+from collections import Counter
+
+from mainapp.reading import dictionary
+
+
+class DoubleArrayTrie:
+    """
+    Characters are mapped to dense codes (most frequent first, so siblings pack tightly). A transition from state s on
+    code c goes to t = base[s] + c, and is valid if check[t] == s. The root is state 0.
+    """
+
+    def __init__(self, words):
+        words = sorted({w for w in words if w})
+        char_counts = Counter(c for w in words for c in w)
+        self.codes = {c: i + 1 for i, (c, _) in enumerate(char_counts.most_common())}
+
+        self.base = array('i', [0])
+        self.check = array('i', [0])
+        self.terminal = bytearray(1)
+        self._used = bytearray(b'\x01')  # Mirrors check != -1, so free slots can be found with bytearray.find
+        self._next_free = 1
+        self._build([[self.codes[c] for c in w] for w in words])
+
+    def _grow(self, size):
+        if size > len(self.check):
+            n = max(size, len(self.check) * 2) - len(self.check)
+            self.base.extend([0] * n)
+            self.check.extend([-1] * n)
+            self.terminal.extend(bytes(n))
+            self._used.extend(bytes(n))
+
+    def _find_base(self, child_codes):
+        first, last = child_codes[0], child_codes[-1]
+        start = pos = max(self._next_free, first + 1)
+        self._grow(start + 1)
+        n_tried = 0
+        while True:
+            # Only consider bases where the first child lands on a free slot
+            pos = self._used.find(0, pos)
+            if pos == -1:
+                pos = len(self._used)
+                self._grow(pos + 1)
+                continue
+            b = pos - first
+            self._grow(b + last + 1)
+            n_tried += 1
+            if all(not self._used[b + c] for c in child_codes):
+                break
+            pos += 1
+
+        # Like darts: once the region we scanned is nearly full, stop scanning it for every new state
+        if (pos - start + 1 - n_tried) / (pos - start + 1) >= 0.95:
+            self._next_free = pos
+        return b
+
+    def _build(self, encoded):
+        # Each item is (state, lo, hi, depth): encoded[lo:hi] all share a prefix of length depth, leading to state
+        stack = [(0, 0, len(encoded), 0)]
+        while stack:
+            state, lo, hi, depth = stack.pop()
+
+            i = lo
+            if i < hi and len(encoded[i]) == depth:
+                # Words are sorted, so a word ending here comes before any longer words sharing its prefix
+                self.terminal[state] = 1
+                i += 1
+
+            children = []
+            while i < hi:
+                code = encoded[i][depth]
+                j = i
+                while j < hi and encoded[j][depth] == code:
+                    j += 1
+                children.append((code, i, j))
+                i = j
+            if not children:
+                continue
+
+            b = self._find_base(sorted(code for code, _, _ in children))
+            self.base[state] = b
+            for code, child_lo, child_hi in children:
+                self.check[b + code] = state
+                self._used[b + code] = 1
+                stack.append((b + code, child_lo, child_hi, depth + 1))
+
+    def prefix_ends(self, s, start):
+        """
+        Yields every end index such that s[start:end] is in the trie, shortest first.
+        """
+        base, check, terminal, codes = self.base, self.check, self.terminal, self.codes
+        n_states = len(check)
+        state = 0
+        for i in range(start, len(s)):
+            code = codes.get(s[i])
+            if code is None:
+                return
+            t = base[state] + code
+            if t >= n_states or check[t] != state:
+                return
+            state = t
+            if terminal[state]:
+                yield i + 1
+
+
+class TrieSegmenter:
+
+    def __init__(self, words, generation=None):
+        self.trie = DoubleArrayTrie(words)
+        self.generation = generation
+
+    def segment(self, s):
+        """
+        Splits s into the fewest tokens, where every token is either a word in the trie or a single character
+        (runs of Latin letters, digits and whitespace are kept together, like jieba does). Ties go to the longer first
+        token.
+        """
+        n = len(s)
+        n_tokens = [0] * (n + 1)
+        next_end = [0] * (n + 1)
+        for i in range(n - 1, -1, -1):
+            best_end, best = i + 1, n_tokens[i + 1] + 1
+            for end in self.trie.prefix_ends(s, i):
+                if end > i + 1 and n_tokens[end] + 1 <= best:
+                    best_end, best = end, n_tokens[end] + 1
+            n_tokens[i], next_end[i] = best, best_end
+
+        words = []
+        i = 0
+        while i < n:
+            end = next_end[i]
+            # Our words are all Hanzi, so numbers and Latin text would otherwise be split into single characters
+            if end == i + 1 and words and _RUN_RE.match(s[i]) and _RUN_RE.match(words[-1][-1]):
+                words[-1] += s[i]
+            else:
+                words.append(s[i:end])
+            i = end
+        return words
+
+
+_RUN_RE = re.compile(r'[a-zA-Z0-9+#&._%\-\s]')
+
+_lock = threading.Lock()
+_segmenter = None
+
+
+def get_segmenter():
+    """
+    Returns a segmenter over the words in the dictionary index, rebuilt whenever the index is reloaded or its set of
+    word strings changes.
+    """
+    global _segmenter
+    dictionary.index.ensure_loaded()
+    generation = dictionary.index.generation
+    if _segmenter is None or _segmenter.generation != generation:
+        with _lock:
+            if _segmenter is None or _segmenter.generation != generation:
+                _segmenter = TrieSegmenter(dictionary.index.get_word_strings(), generation=generation)
+    return _segmenter
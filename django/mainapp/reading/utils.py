@@ -1,7 +1,7 @@
 import re
 
 import unicodedata
-import xml
+import xml.parsers.expat
 
 from bs4 import BeautifulSoup
 
@@ -32,12 +32,9 @@ def print_aligned(s, annotation):
 
 def show_annotations(article):
     print("WORD ANNOTATIONS:")
-    for annotation in Annotation.objects.filter(
-        article=article,
-        type__in=[Annotation.TYPE_WORD, Annotation.TYPE_CHARACTER],
-    ):
+    for start, length, _, word_pk, cp_pk in Annotation.objects.get_word_annotation_values(article.pk):
         print()
-        print_aligned(article.body, (annotation.start, annotation.length, annotation.word or annotation.cp))
+        print_aligned(article.body, (start, length, Word.objects.get(pk=word_pk) if word_pk else CharacterPinyin.objects.get(pk=cp_pk)))
 
     print("\nPHRASE ANNOTATIONS:")
     for annotation in Annotation.objects.filter(article=article, type=Annotation.TYPE_PHRASE):
@@ -93,50 +90,38 @@ def get_text(xml_fragment):
     return soup.get_text()
 
 
+ITER_TEXT_CHUNK_SIZE = 1 << 16
+
+
 def iter_text(xml_string):
+    """
+    Yields (char_offset, text) for each text node, in document order.
+    """
     assert html.unescape(xml_string) == xml_string, "Check there are no HTML entities (like &amp;) in article body - this isn't supported"
 
+    encoded = xml_string.encode('UTF-8')
     res = []
-
-    def start_element(name, attrs):
-        pass
-
-    def end_element(name):
-        pass
+    # expat reports byte offsets. They only ever increase, so convert them by decoding just the bytes since the last one
+    last_byte_index = 0
+    last_char_index = 0
 
     def char_data(data):
-        char_index = len(xml_string.encode('UTF-8')[:p.CurrentByteIndex].decode())
-        res.append((char_index, data))
-
+        nonlocal last_byte_index, last_char_index
+        last_char_index += len(encoded[last_byte_index:p.CurrentByteIndex].decode('UTF-8'))
+        last_byte_index = p.CurrentByteIndex
+        res.append((last_char_index, data))
 
     p = xml.parsers.expat.ParserCreate()
-    p.StartElementHandler = start_element
-    p.EndElementHandler = end_element
     p.CharacterDataHandler = char_data
-    p.Parse(xml_string, True)
-
-    return res
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
 
+    # Feed the document in chunks ending just after a tag, so no text node is split across chunks
+    start = 0
+    is_final = False
+    while not is_final:
+        end = encoded.find(b'>', start + ITER_TEXT_CHUNK_SIZE)
+        is_final = end == -1 or end + 1 == len(encoded)
+        end = len(encoded) if is_final else end + 1
+        p.Parse(encoded[start:end], is_final)
+        start = end
+        yield from res
+        res.clear()
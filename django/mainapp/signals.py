@@ -1,8 +1,11 @@
-
+from django.db import transaction
 from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 
-from mainapp.models import Annotation
+from mainapp import tasks
+from mainapp.models import Annotation, Word, CharacterPinyin, DictionaryVersion
+from mainapp.models.core import words_bulk_created
+from mainapp.reading import dictionary
 
 
 @receiver(post_delete, sender=Annotation)
@@ -15,3 +18,47 @@ def delete_phrase_annotation(sender, instance, **kwargs):
 post_delete.connect(delete_phrase_annotation, sender=Annotation)
 
 
+# Keep this process's dictionary index in sync. Only apply changes once they're committed, otherwise a rolled back
+# Word.create_from_chars would leave pks in the index that don't exist. Every change also bumps DictionaryVersion, in
+# the same transaction, so other processes (e.g. the Celery workers) reload their index.
+
+@receiver(post_save, sender=Word)
+def add_word_to_index(sender, instance, created, **kwargs):
+    DictionaryVersion.objects.bump()
+    if created:
+        transaction.on_commit(lambda: dictionary.index.add_word(instance))
+        tasks.reannotate_articles_with_words.delay_on_commit([instance.char_string])
+
+
+@receiver(post_delete, sender=Word)
+def remove_word_from_index(sender, instance, **kwargs):
+    DictionaryVersion.objects.bump()
+    transaction.on_commit(lambda: dictionary.index.remove_word(instance))
+
+
+@receiver(words_bulk_created, sender=Word)
+def add_bulk_created_to_index(sender, words, cps, **kwargs):
+    DictionaryVersion.objects.bump()
+
+    def add_to_index():
+        for cp in cps:
+            dictionary.index.add_cp(cp)
+        for word in words:
+            dictionary.index.add_word(word)
+    transaction.on_commit(add_to_index)
+    # Articles already processed would otherwise only get the new words if they were processed again
+    tasks.reannotate_articles_with_words.delay_on_commit(sorted({word.char_string for word in words}))
+
+
+@receiver(post_save, sender=CharacterPinyin)
+def add_cp_to_index(sender, instance, created, **kwargs):
+    DictionaryVersion.objects.bump()
+    if created:
+        transaction.on_commit(lambda: dictionary.index.add_cp(instance))
+
+
+@receiver(post_delete, sender=CharacterPinyin)
+def remove_cp_from_index(sender, instance, **kwargs):
+    DictionaryVersion.objects.bump()
+    transaction.on_commit(lambda: dictionary.index.remove_cp(instance))
+
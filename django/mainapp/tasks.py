@@ -2,21 +2,33 @@ import traceback
 import requests
 
 from asgiref.sync import async_to_sync
-from celery import shared_task
+from celery import chord, shared_task
+from celery.signals import worker_process_init
 from channels.layers import get_channel_layer
+from django.conf import settings
 from django.db import transaction
+from django.db.models import Q
 
 from cndict.settings import OPENAI_API_KEY
 
 from mainapp import gpt
+from mainapp.broadcast import CoalescingGroupSender
 from mainapp.gpt import GPTError
-from mainapp.models import Article, update_atomic
+from mainapp.models import Article, Annotation, ReaderPayload, update_atomic
 from mainapp.reading import annotate
 from mainapp.reading import inflate
-from mainapp.reading.utils import strip_tags
+from mainapp.reading import dedupe, dictionary, document, jieba_dict
 
 
 
+@worker_process_init.connect
+def load_dictionary_index(**kwargs):
+    # Load the dictionary index and jieba's prefix dictionary once per worker process, rather than on the first
+    # article it processes
+    dictionary.index.ensure_loaded()
+    jieba_dict.get_tokenizer()
+
+
 @shared_task
 def generate_audio(article_pk):
     article = Article.objects.get(pk=article_pk)
@@ -58,6 +70,7 @@ def update_article_summary(article_pk):
 
     print(f"About to save. Summary: {summary}")
     update_atomic(article, 'english_summary', summary)
+    ReaderPayload.objects.invalidate(article.pk)
     print(f"Finished save: {article.english_summary}")
 
     # Without on_commit, the update might be sent before the update is saved to the DB. This means the frontend
@@ -78,44 +91,74 @@ def update_article_summary(article_pk):
 @shared_task
 def update_phrase_annotations(article_pk):
 
-    async def cb(phrase):
-        # This is run whenever an updated phrase translation has been saved
+    article = Article.objects.get(pk=article_pk)
 
-        await get_channel_layer().group_send(
-            phrase.annotation.article.channel_name,
-            {
-                'type': 'phrase_update',
-                'message': phrase.compute_client_obj(),
-            }
-        )
+    async def update():
+        # Phrases are translated in quick succession, so send them to clients in batches rather than one at a time
+        async with CoalescingGroupSender(article.channel_name, 'phrases_update',
+                                         max_delay=settings.PHRASE_UPDATE_MAX_DELAY,
+                                         max_items=settings.PHRASE_UPDATE_MAX_ITEMS) as sender:
 
-    article = Article.objects.get(pk=article_pk)
-    async_to_sync(annotate.phrases.update_phrase_annotations)(article, cb)
+            async def cb(phrase):
+                # This is run whenever an updated phrase translation has been saved
+                await sender.add(phrase.compute_client_obj())
+
+            await annotate.phrases.update_phrase_annotations(article, cb)
+
+    async_to_sync(update)()
 
     print("All phrase annotations updated")
 
+    annotate.translation_cache.log_stats()
+    annotate.translation_cache.evict()
 
-@shared_task
-def process_article(article_pk):
 
-    channel_layer = get_channel_layer()
+def _send_status(article, status):
+    # Without on_commit, the loading page might hear about the article before it can load it
+    def send_update_to_ws():
+        async_to_sync(get_channel_layer().group_send)(
+            article.loading_channel_name,
+            {'type': status}
+        )
+    transaction.on_commit(send_update_to_ws)
+
 
-    def send_success():
-        def send_update_to_ws():
-            async_to_sync(channel_layer.group_send)(
-                article.loading_channel_name,
-                {'type': 'status_success'}
-            )
-        transaction.on_commit(send_update_to_ws)
+def _split_text_nodes(text_nodes, n_batches):
+    # Contiguous batches of roughly equal total length, so the annotating tasks take about as long as each other
+    total = sum(len(text) for _, text in text_nodes)
+    batches, batch, batch_length = [], [], 0
+    for i, text in text_nodes:
+        batch.append((i, text))
+        batch_length += len(text)
+        if batch_length >= total / n_batches:
+            batches.append(batch)
+            batch, batch_length = [], 0
+    if batch:
+        batches.append(batch)
+    return batches
 
-    def send_error():
-        def send_update_to_ws():
-            async_to_sync(channel_layer.group_send)(
-                article.loading_channel_name,
-                {'type': 'status_error'}
-            )
-        transaction.on_commit(send_update_to_ws)
 
+def _finish_processing(article, docs, source=None):
+    inflate.save_inflated(article, docs=docs)
+
+    # We can open the article detail page before the results of the below are complete - so we run them
+    # as separate tasks and pipe the results to the user in realtime
+    if source is None or not article.english_summary:
+        update_article_summary.delay_on_commit(article.pk)
+
+    # Only translates phrases that are still placeholders, which copied phrases never are
+    update_phrase_annotations.delay_on_commit(article.pk)
+
+    update_atomic(article, 'is_ready_to_view', True)
+
+    # Call the new TTS task
+    generate_audio.delay_on_commit(article.pk)
+
+    _send_status(article, 'status_success')
+
+
+@shared_task
+def process_article(article_pk):
 
     article = Article.objects.get(pk=article_pk)
 
@@ -124,27 +167,144 @@ def process_article(article_pk):
 
     try:
 
-        update_atomic(article, 'plaintext', strip_tags(f"{article.title or ''}\n\n{article.body or ''}").strip())
-        annotate.words.fast_annotate(article)
-        annotate.phrases.annotate_phrases_with_placeholders(article)
-        inflate.save_inflated(article)
-
-        # We can open the article detail page before the results of the below are complete - so we run them
-        # as separate tasks and pipe the results to the user in realtime
-        update_article_summary.delay_on_commit(article.pk)
+        update_atomic(article, 'content_hash', dedupe.get_content_hash(article))
+        source = dedupe.find_source_article(article)
 
-        update_phrase_annotations.delay_on_commit(article.pk)
+        # Parse the article once, and share it between all stages
+        docs = document.parse_article(article)
+        if source:
+            dedupe.copy_processed_fields(source, article)
+            _finish_processing(article, docs, source)
+            return
 
-        update_atomic(article, 'is_ready_to_view', True)
-
-        # Call the new TTS task
-        generate_audio.delay_on_commit(article.pk)
+        update_atomic(article, 'plaintext', document.get_plaintext(article, docs))
+        text_nodes = docs[Annotation.FIELD_BODY].text_nodes if Annotation.FIELD_BODY in docs else []
 
     except Exception:
-        send_error()
+        _send_status(article, 'status_error')
         raise
 
-    return send_success()
+    # Annotate the text nodes in parallel, then save them all and carry on once they're all done
+    chord(
+        annotate_text_nodes.s(batch)
+        for batch in _split_text_nodes(text_nodes, settings.ANNOTATION_TASKS_PER_ARTICLE)
+    )(
+        save_annotations_and_finish.s(article.pk).on_error(process_article_failed.s(article.pk))
+    )
+
 
+@shared_task
+def annotate_text_nodes(text_nodes):
+    return annotate.words.get_text_node_annotations(text_nodes)
 
 
+@shared_task
+def save_annotations_and_finish(annotation_batches, article_pk):
+    article = Article.objects.get(pk=article_pk)
+    annotate.words.save_annotations(article, [a for batch in annotation_batches for a in batch])
+    docs = document.parse_article(article)
+    annotate.phrases.annotate_phrases_with_placeholders(article, docs=docs)
+    _finish_processing(article, docs)
+
+
+@shared_task
+def process_article_failed(request, exc, tb, article_pk):
+    # Runs if any of process_article's annotating tasks fail, or save_annotations_and_finish does
+    print(f"Error processing article {article_pk}: {exc!r}")
+    _send_status(Article.objects.get(pk=article_pk), 'status_error')
+
+
+def _send_inflated_update(article, reinflated, annotations):
+    # Sends the re-rendered text nodes, with the client_objs of the words and CPs in them. If the inflated XML couldn't
+    # be updated in place, clients get the whole thing instead
+    if reinflated is None:
+        message_type = 'inflated_refresh'
+        message = {
+            'inflated': inflate.get_inflated(article),
+            'version': article.inflated_version,
+            'words': dict(article.get_word_client_objs()),
+            'cps': dict(article.get_cp_client_objs()),
+        }
+    else:
+        from_version, fragments = reinflated
+        word_pks = {word_pk for _, _, _, word_pk, _ in annotations if word_pk}
+        cp_pks = {cp_pk for _, _, _, _, cp_pk in annotations if cp_pk}
+        message_type = 'inflated_update'
+        message = {
+            'fromVersion': from_version,
+            'version': article.inflated_version,
+            'fragments': [{'start': start, 'end': end, 'xml': xml} for start, end, xml in fragments],
+            'newWords': dict(Article.objects.get_word_client_objs_for(word_pks)),
+            'newCps': dict(Article.objects.get_cp_client_objs_for(word_pks, cp_pks)),
+        }
+
+    def send_update_to_ws():
+        async_to_sync(get_channel_layer().group_send)(
+            article.channel_name,
+            {
+                'type': message_type,
+                'message': message,
+            }
+        )
+    transaction.on_commit(send_update_to_ws)
+
+
+@shared_task
+def reannotate_articles_with_words(char_strings):
+    """
+    Re-annotates the text containing any of char_strings (e.g. newly created Words) in every processed article, one task
+    per article.
+    """
+    # Narrowed down in batches, so a large import doesn't make one huge query
+    candidates = {}
+    for k in range(0, len(char_strings), settings.REANNOTATE_WORDS_PER_QUERY):
+        contains_any = Q()
+        for char_string in char_strings[k:k + settings.REANNOTATE_WORDS_PER_QUERY]:
+            contains_any |= Q(plaintext__contains=char_string)
+        candidates.update(
+            Article.objects.filter(contains_any).exclude(inflated_version=0).values_list('pk', 'plaintext')
+        )
+
+    for article_pk, plaintext in sorted(candidates.items()):
+        reannotate_article_words.delay(article_pk, [x for x in char_strings if x in plaintext])
+
+
+@shared_task
+def reannotate_article_words(article_pk, char_strings):
+    # Re-annotates just the body text nodes that contain any of char_strings
+    article = Article.objects.get(pk=article_pk)
+    docs = document.parse_article(article)
+    if Annotation.FIELD_BODY not in docs:
+        return
+    spans = [
+        (i, i + len(text)) for i, text in docs[Annotation.FIELD_BODY].text_nodes
+        if any(char_string in text for char_string in char_strings)
+    ]
+    if settings.SEGMENTATION_ENGINE == annotate.words.SEGMENTER_JIEBA:
+        jieba_dict.add_words(char_strings)
+    _reannotate_spans(article, spans, docs)
+
+
+@shared_task
+def reannotate_article_text(article_pk, spans):
+    """
+    Re-annotates the words in the (start, end) spans of an article's body, and re-renders and sends to readers only the
+    text nodes that changed, rather than the whole article.
+    """
+    article = Article.objects.get(pk=article_pk)
+    _reannotate_spans(article, spans, document.parse_article(article))
+
+
+def _reannotate_spans(article, spans, docs):
+    # The dictionary has usually just changed, so don't wait for the index's next check to see it
+    dictionary.index.ensure_loaded(check_now=True)
+    text_node_spans, annotations = annotate.words.reannotate_text_nodes(article, spans, docs=docs)
+    if not text_node_spans:
+        return
+
+    reinflated = inflate.reinflate_text_nodes(
+        article,
+        [(Annotation.FIELD_BODY, start, end) for start, end in text_node_spans],
+        docs=docs,
+    )
+    _send_inflated_update(article, reinflated, annotations)
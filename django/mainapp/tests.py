@@ -0,0 +1,220 @@
+import itertools
+import random
+import re
+import uuid
+from collections import defaultdict
+
+import jieba
+from django.test import SimpleTestCase, TestCase
+
+from mainapp.models import (
+    Annotation, Article, Character, CharacterPinyin, Meaning, PhraseAnnotation, Pinyin, Syllable, Word,
+)
+from mainapp.reading import inflate
+from mainapp.reading.annotate.phrases import _get_phrase_annotations
+from mainapp.reading.document import ParsedDocument
+from mainapp.reading.utils import clean_article_body
+from mainapp.utils import HANZI_PATTERN
+from mainapp.views.core import clean_sample_html, sample_news, sample_blogpost, sample_book
+
+
+def _old_inflate_text(text, annotations, char_phrases, chunk_offset):
+    # inflate_text before cids were assigned in a single pass, which recomputed every cid for each character
+    assert len(char_phrases) == len(text)
+
+    chars = []
+    j = 0
+    for i, c in enumerate(text):
+        if j == len(annotations):
+            char_obj = None
+            group_key = uuid.uuid4().hex
+        else:
+            if i >= annotations[j][0] + annotations[j][1]:
+                j += 1
+
+            if j < len(annotations) and annotations[j][0] <= i:
+                char_obj = annotations[j][2]
+                group_key = j
+            else:
+                char_obj = None
+                group_key = uuid.uuid4().hex
+
+        if c == ' ':
+            c = '&nbsp;'
+
+        chars.append({
+            'char': c,
+            'obj': char_obj,
+            'group_key': group_key,
+            'phrase': char_phrases[i],
+        })
+
+        counters = defaultdict(int)  # maps char_string -> current char_string_counter
+        group_keys_seen = set()
+        for char in chars:
+            if char['obj'] is None:
+                char_string = c
+            else:
+                char_string = char['obj'].char_string
+            if char['group_key'] not in group_keys_seen:
+                counters[char_string] += 1
+            char['cid'] = f"{chunk_offset}-{inflate._fasthash(char_string)}-{counters[char_string]}"
+            group_keys_seen.add(char['group_key'])
+
+    def render_group(g):
+        g = list(g)
+        if len(g) > 1 or isinstance(g[0]['obj'], Word):
+            char_string = "".join([char["char"] for char in g])
+            return f'<d:word cid="{g[0]["cid"]}" obj="{g[0]["obj"].pk}" phrase="{g[0]["phrase"].pk if g[0]["phrase"] else ""}">{char_string}</d:word>'
+        char = g[0]
+        if isinstance(char['obj'], CharacterPinyin):
+            return f'<d:cp cid="{char["cid"]}" obj="{char["obj"].pk}" phrase="{char["phrase"].pk if char["phrase"] else ""}">{char["char"]}</d:cp>'
+        return f'<d:plain cid="{char["cid"]}" phrase="{char["phrase"].pk if char["phrase"] else ""}">{char["char"]}</d:plain>'
+
+    return ''.join(render_group(g) for _, g in itertools.groupby(chars, lambda char: char['group_key']))
+
+
+class InflateTextTest(SimpleTestCase):
+
+    def setUp(self):
+        self.words = [Word(pk=i, char_string=s) for i, s in enumerate(['你好', '世界', '好的', '你好'])]
+        self.cps = []
+        for i, char in enumerate('你好世'):
+            cp = CharacterPinyin(pk=i)
+            cp.character = Character(char=char)
+            self.cps.append(cp)
+        self.phrases = [PhraseAnnotation(pk=i) for i in range(3)]
+
+    def get_random_layout(self, rng):
+        # A chunk of text with non-overlapping Word and CP annotations, each inside at most one phrase
+        n_chars = rng.randint(0, 30)
+        text = ''.join(rng.choice('你好世界 ab,') for _ in range(n_chars))
+        annotations = []
+        i = 0
+        while i < n_chars:
+            r = rng.random()
+            if r < 0.3 and i + 2 <= n_chars:
+                annotations.append((i, 2, rng.choice(self.words)))
+                i += 2
+            elif r < 0.6:
+                annotations.append((i, 1, rng.choice(self.cps)))
+                i += 1
+            else:
+                i += 1
+
+        char_phrases = [None] * n_chars
+        for start, length, _ in annotations:
+            phrase = rng.choice(self.phrases + [None])
+            for c in range(start, start + length):
+                char_phrases[c] = phrase
+        return text, annotations, char_phrases, rng.randint(0, 1000)
+
+    def test_matches_old_implementation(self):
+        rng = random.Random(0)
+        for _ in range(3000):
+            text, annotations, char_phrases, chunk_offset = self.get_random_layout(rng)
+            self.assertEqual(
+                inflate.inflate_text(text, annotations, char_phrases, chunk_offset),
+                _old_inflate_text(text, annotations, char_phrases, chunk_offset),
+                (text, annotations, chunk_offset),
+            )
+
+    def get_sample_layouts(self, tokenizer, xml_string):
+        # Each text node of the article, annotated the way annotate.words does: a Word for each multi-character token,
+        # and a CP for each single character. jieba's stock dictionary stands in for ours, which needs the database.
+        doc = ParsedDocument(xml_string)
+        objs = {}
+        phrases = [(start, start + length, PhraseAnnotation(pk=k)) for k, (start, length, _, _) in enumerate(
+            _get_phrase_annotations(doc))]
+
+        for i, text in doc.text_nodes:
+            annotations = []
+            j = 0
+            for token in tokenizer.cut(text):
+                if re.fullmatch(rf'[{HANZI_PATTERN}]+', token):
+                    if token not in objs:
+                        if len(token) > 1:
+                            objs[token] = Word(pk=len(objs), char_string=token)
+                        else:
+                            objs[token] = CharacterPinyin(pk=len(objs))
+                            objs[token].character = Character(char=token)
+                    annotations.append((j, len(token), objs[token]))
+                j += len(token)
+
+            char_phrases = [
+                next((phrase for start, end, phrase in phrases if start <= i + c < end), None)
+                for c in range(len(text))
+            ]
+            yield text, annotations, char_phrases, i
+
+    def test_matches_old_implementation_on_sample_articles(self):
+        tokenizer = jieba.Tokenizer()
+        for name, html in [('news', sample_news), ('blogpost', sample_blogpost), ('book', sample_book)]:
+            layouts = list(self.get_sample_layouts(tokenizer, clean_article_body(clean_sample_html(html))))
+            self.assertTrue(any(annotations for _, annotations, _, _ in layouts), name)
+            for text, annotations, char_phrases, chunk_offset in layouts:
+                self.assertEqual(
+                    inflate.inflate_text(text, annotations, char_phrases, chunk_offset),
+                    _old_inflate_text(text, annotations, char_phrases, chunk_offset),
+                    (name, chunk_offset),
+                )
+
+
+def _apply_utf16_fragments(inflated, fragments):
+    # As the reader does, with offsets in UTF-16 code units
+    inflated = inflated.encode('utf-16-le')
+    for start, end, xml in reversed(fragments):
+        inflated = inflated[:2 * start] + xml.encode('utf-16-le') + inflated[2 * end:]
+    return inflated.decode('utf-16-le')
+
+
+class ReinflateTextNodesTest(TestCase):
+
+    def setUp(self):
+        pinyin = Pinyin.objects.create(syllable=Syllable.objects.create(written='a'), tone=1, written='ā')
+        self.cps = {
+            char: CharacterPinyin.objects.create(character=Character.objects.create(char=char), pinyin=pinyin)
+            for char in '你好世界'
+        }
+        self.word = Word.objects.create(
+            meaning=Meaning.objects.create(), char_string='世界', pinyin_string='ā ā', pinyin_string_numeric='a1 a1',
+        )
+        # expat splits the first paragraph's text at the newline, so there's no markup after its first two text nodes,
+        # and the emoji are one character each but two UTF-16 code units
+        self.article = Article.objects.create(title='你好', body='<div><p>😀你好\n世界你好</p><p>世界😀好</p></div>')
+        self.doc = ParsedDocument(self.article.body)
+
+    def get_cp_annotations(self, i, text):
+        return [
+            (i + k, 1, Annotation.TYPE_CHARACTER, None, self.cps[char].pk)
+            for k, char in enumerate(text) if char in self.cps
+        ]
+
+    def test_fragments_match_render_inflated(self):
+        Annotation.objects.replace_word_annotations(self.article.pk, [
+            annotation for i, text in self.doc.text_nodes for annotation in self.get_cp_annotations(i, text)
+        ])
+        inflate.save_inflated(self.article)
+        self.article.refresh_from_db()
+        old = self.article.inflated
+
+        # Annotate 世界 as a Word in both text nodes containing it
+        changed = [(i, text) for i, text in self.doc.text_nodes if '世界' in text]
+        self.assertEqual([i for i, _ in changed], [12, 23])
+        annotations = []
+        for i, text in changed:
+            k = text.index('世界')
+            annotations += [x for x in self.get_cp_annotations(i, text) if not i + k <= x[0] < i + k + 2]
+            annotations.append((i + k, 2, Annotation.TYPE_WORD, self.word.pk, None))
+        spans = [(i, i + len(text)) for i, text in changed]
+        Annotation.objects.replace_word_annotations(self.article.pk, annotations, spans=spans)
+
+        from_version, fragments = inflate.reinflate_text_nodes(
+            self.article, [(Annotation.FIELD_BODY, start, end) for start, end in spans],
+        )
+        self.assertEqual(len(fragments), 2)
+        self.article.refresh_from_db()
+        self.assertEqual(from_version + 1, self.article.inflated_version)
+        self.assertIn(f'obj="{self.word.pk}"', self.article.inflated)
+        self.assertEqual(_apply_utf16_fragments(old, fragments), inflate.render_inflated(self.article))
+        self.assertEqual(self.article.inflated, inflate.render_inflated(self.article))
@@ -3,76 +3,113 @@ REST API for react article reader.
 """
 import json
 
-from django.http import JsonResponse
+import xxhash
+from django.conf import settings
+from django.http import JsonResponse, HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags
 from django.utils.decorators import method_decorator
 from django.views import View
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework import generics, serializers
+from rest_framework.renderers import JSONRenderer
 
-from mainapp.models import Article, Word, CharacterPinyin, PhraseAnnotation
-
-
-class WordSerializer(serializers.ModelSerializer):
-
-    class Meta:
-        model = Word
-        fields = ['pk', 'client_obj']
-
-
-class CharacterPinyinSerializer(serializers.ModelSerializer):
-
-    class Meta:
-        model = CharacterPinyin
-        fields = ['pk', 'client_obj']
-
-
-class PhraseSerializer(serializers.ModelSerializer):
-
-    client_obj = serializers.SerializerMethodField()
-
-    def get_client_obj(self, obj):
-        return obj.compute_client_obj()
-
-    class Meta:
-        model = PhraseAnnotation
-        fields = ['pk', 'client_obj']
+from mainapp.models import Article, ReaderPayload
+from mainapp.reading import inflate
 
 
 class ArticleSerializer(serializers.ModelSerializer):
 
+    inflated = serializers.SerializerMethodField()
     words = serializers.SerializerMethodField()
     cps = serializers.SerializerMethodField()
     phrases = serializers.SerializerMethodField()
 
     class Meta:
         model = Article
-        fields = ['pk', 'english_summary', 'inflated', 'words', 'cps', 'phrases']
+        fields = ['pk', 'english_summary', 'inflated', 'inflated_version', 'words', 'cps', 'phrases']
+
+    def get_inflated(self, obj):
+        return inflate.get_inflated(obj)
 
     def get_words(self, obj):
-        words = obj.get_words()
-        return WordSerializer(words, many=True).data
+        return dict(obj.get_word_client_objs())
 
     def get_cps(self, obj):
-        cps = obj.get_cps()
-        return CharacterPinyinSerializer(cps, many=True).data
+        return dict(obj.get_cp_client_objs())
 
     def get_phrases(self, obj):
-        phrases = obj.get_phrases()
-        return PhraseSerializer(phrases, many=True).data
+        return dict(obj.get_phrase_client_objs())
+
 
-    def to_representation(self, instance):
-        # Return dicts instead of lists
-        representation = super().to_representation(instance)
-        representation['words'] = {x['pk']: x['client_obj'] for x in representation['words']}
-        representation['cps'] = {x['pk']: x['client_obj'] for x in representation['cps']}
-        representation['phrases'] = {x['pk']: x['client_obj'] for x in representation['phrases']}
-        return representation
+class LazyArticleSerializer(ArticleSerializer):
+    # With settings.LAZY_INFLATION, the inflated XML and its version are added to each response rather than stored
+    inflated = None
+
+    class Meta(ArticleSerializer.Meta):
+        fields = ['pk', 'english_summary', 'words', 'cps', 'phrases']
+
+
+def _add_inflated(payload, article):
+    # The payload is a JSON object, so the fields can be appended to it without parsing it
+    inflated = json.dumps(
+        {'inflated': inflate.get_inflated(article), 'inflated_version': article.inflated_version},
+        ensure_ascii=False,
+    )
+    return payload[:-1] + ',' + inflated[1:]
 
 
 class ArticleReaderAPIView(generics.RetrieveAPIView):
-    serializer_class = ArticleSerializer
+    """
+    Serves the serialized article from ReaderPayload, only building it when it's been invalidated. Responses have an
+    ETag, so a client that already has the current payload gets a 304 instead.
+
+    With settings.LAZY_INFLATION, the stored payload leaves out the inflated XML, which is only rendered (or found in
+    the cache) when the client doesn't already have the article's current inflated_version.
+    """
     queryset = Article.objects.all()
 
+    def get_serializer_class(self):
+        return LazyArticleSerializer if settings.LAZY_INFLATION else ArticleSerializer
+
+    def retrieve(self, request, *args, **kwargs):
+        article_pk = self.kwargs['pk']
+        cached = ReaderPayload.objects.filter(article_id=article_pk).exclude(payload=None).values_list(
+            'payload', 'etag').first()
+        if cached:
+            payload, etag = cached
+        else:
+            payload, etag = self.build_payload()
+
+        if not settings.LAZY_INFLATION:
+            return self.get_response(etag, lambda: payload)
+        article = self.get_object()
+        return self.get_response(f'{etag}-{article.inflated_version}', lambda: _add_inflated(payload, article))
+
+    def build_payload(self):
+        article = self.get_object()
+        reader_payload, _ = ReaderPayload.objects.get_or_create(article=article)
+
+        # Anything that changes after this point invalidates the payload and bumps the version, so the update below
+        # only saves it if it's still current
+        payload = JSONRenderer().render(self.get_serializer(article).data).decode()
+        etag = xxhash.xxh64(payload.encode()).hexdigest()
+        ReaderPayload.objects.filter(article=article, version=reader_payload.version).update(
+            payload=payload,
+            etag=etag,
+        )
+        return payload, etag
+
+    def get_response(self, etag, get_payload):
+        quoted_etag = f'"{etag}"'
+        if quoted_etag in parse_etags(self.request.headers.get('If-None-Match', '')):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(get_payload(), content_type='application/json')
+        response['ETag'] = quoted_etag
+        # Always revalidate, since translations and the summary keep arriving after the first load
+        response['Cache-Control'] = 'no-cache'
+        return response
+
 
 @method_decorator(csrf_exempt, name='dispatch')
 class ReaderFeedbackAPIView(View):
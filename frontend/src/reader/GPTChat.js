@@ -9,6 +9,7 @@ class GPTChat extends React.Component {
   }
 
   websocket = null;
+  streamedMessage = '';
 
   handleInputChange = (event) => {
     this.setState({input: event.target.value});
@@ -41,7 +42,14 @@ class GPTChat extends React.Component {
 
       this.websocket.onmessage = (event) => {
         const response = JSON.parse(event.data);
-        this.props.addChatMessage(this.props.chatIdentifier, "assistant", response.message)
+        if (response.type === 'delta') {
+          // Show the response as it streams in, replacing the partial message each time
+          this.streamedMessage += response.delta;
+          this.props.addChatMessage(this.props.chatIdentifier, "assistant", this.streamedMessage, true)
+        } else {
+          this.streamedMessage = '';
+          this.props.addChatMessage(this.props.chatIdentifier, "assistant", response.message)
+        }
       };
 
       this.websocket.onopen = () => {
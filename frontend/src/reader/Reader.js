@@ -22,6 +22,7 @@ class Reader extends React.Component {
     // {
     //   article: {
     //     source: null,  // (inflated html)
+    //     sourceVersion: null,  // inflated_version of source, see updateInflated
     //     summary: null,
     //   },
     //   words: null,
@@ -139,11 +140,17 @@ class Reader extends React.Component {
     return this.state.chats[this.getActiveChatIdentifier()] ?? [];
   }
 
-  addChatMessage = (chatIdentifier, sender, message) => {
+  addChatMessage = (chatIdentifier, sender, message, isPartial = false) => {
     this.setState(prevState => {
       const newChats = { ...prevState.chats };
       const updatedChat = newChats[chatIdentifier] ? [...newChats[chatIdentifier]] : [];
-      updatedChat.push({ sender, message });
+      // A partial message (still being streamed) is replaced in place by the next update to it
+      const partialIndex = updatedChat.findIndex(msg => msg.isPartial && msg.sender === sender);
+      if (partialIndex !== -1) {
+        updatedChat[partialIndex] = { sender, message, isPartial };
+      } else {
+        updatedChat.push({ sender, message, isPartial });
+      }
 
       return {
         chats: {
@@ -164,6 +171,10 @@ class Reader extends React.Component {
     this.websocket = new WebSocket(wsUrl);
     this.websocket.onmessage = this.handleWebSocketMessage;
 
+    this.fetchPayload();
+  }
+
+  fetchPayload = () => {
     fetch(`/api/v0/reader/articles/${this.props.articlePk}`)
       .then(res => res.json())
       .then((data) => {
@@ -175,6 +186,7 @@ class Reader extends React.Component {
           data: {
             article: {
               source: data['inflated'],
+              sourceVersion: data['inflated_version'],
               summary: data['english_summary'],
             },
             words: words,
@@ -202,7 +214,10 @@ class Reader extends React.Component {
 
     const message = JSON.parse(event.data);
     if (message.type === 'phrase' && message.data) {
-      this.updatePhrase(message.data);
+      this.updatePhrases([message.data]);
+
+    } else if (message.type === 'phrases' && message.data) {
+      this.updatePhrases(message.data);
 
     } else if (message.type === 'summary' && message.data) {
       this.updateSummary(message.data);
@@ -217,10 +232,13 @@ class Reader extends React.Component {
 
   };
 
-  updatePhrase = (newPhrase) => {
+  updatePhrases = (newPhrases) => {
+    // A batch of phrases is applied in one state update, so it only causes one re-render
     this.setState(prevState => {
       const updatedPhrases = { ...prevState.data.phrases };
-      updatedPhrases[newPhrase.pk] = newPhrase;
+      for (const newPhrase of newPhrases) {
+        updatedPhrases[newPhrase.pk] = newPhrase;
+      }
       return {
         data: {
           ...prevState.data,
@@ -243,13 +261,28 @@ class Reader extends React.Component {
   };
 
   updateInflated = (newData) => {
+    // Only the re-rendered text nodes are sent, as replacements for spans of the inflated XML at newData.fromVersion
+    // (in UTF-16 code units, so they match string indices here).
+    // If ours is a different version we can't apply them, so fetch the whole article again instead
+    if (this.state.data.article.sourceVersion !== newData.fromVersion) {
+      console.log("Inflated is out of date, fetching it again")
+      this.fetchPayload();
+      return;
+    }
+
     console.log("Updating inflated (i.e. segmentation)")
+    let source = this.state.data.article.source;
+    for (const fragment of [...newData.fragments].reverse()) {
+      source = source.slice(0, fragment.start) + fragment.xml + source.slice(fragment.end);
+    }
+
     this.setState(prevState => ({
       data: {
         ...prevState.data,
         article: {
           ...prevState.data.article,
-          source: newData.inflated,
+          source: source,
+          sourceVersion: newData.version,
         },
         cps: {
           ...prevState.data.cps,
@@ -272,6 +305,7 @@ class Reader extends React.Component {
         article: {
           ...prevState.data.article,
           source: newData.inflated,
+          sourceVersion: newData.version,
         },
         cps: newData.cps,
         words: newData.words,